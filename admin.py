@@ -34,9 +34,23 @@ class PageAdmin(admin.ModelAdmin):
     list_display = ('link_name', 'number_of_HTML_visits', 'is_toc',
                     'html_title',)
 
+class PublishJobAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'status', 'force', 'phase', 'pages_processed',
+                    'pages_total', 'revision_changeset', 'started_on',
+                    'finished_on',)
+    list_filter = ('status', )
+    readonly_fields = ('report', )
+
+class PageSearchTextAdmin(admin.ModelAdmin):
+    list_per_page = 2000
+    list_display = ('page', 'is_compressed',)
+    list_filter = ('is_compressed', )
+
 admin.site.register(models.CommentPoster, CommentPosterAdmin)
 admin.site.register(models.Link)
 admin.site.register(models.Page, PageAdmin)
+admin.site.register(models.PageSearchText, PageSearchTextAdmin)
+admin.site.register(models.PublishJob, PublishJobAdmin)
 admin.site.register(models.Hit, HitAdmin)
 admin.site.register(models.Tag)
 admin.site.register(models.CommentReference, CommentReferenceAdmin)
@@ -283,6 +283,52 @@ log_filename = mkdtemp() + sep + 'ucomment-app.log'
 cache_count_duration = 0.6
 cache_count_timout = 60 * 60 * 6
 
+# Search results are shown in pages of ``search_results_per_page`` results.
+# Visitors can request a different number in the search URL (e.g. add
+# ``/offset=20/limit=50`` to the URL), but never more than the maximum.
+search_results_per_page = 20
+search_results_max_per_page = 100
+
+# The instant search (shown while the visitor types in the search box) returns
+# this many results, each with ``search_api_context`` characters around the
+# search term.  The Javascript may request up to ``search_api_max_results``.
+# Results are cached for ``search_api_cache_timeout`` seconds; set it to zero
+# (0) for no caching.
+search_api_results = 8
+search_api_max_results = 50
+search_api_context = 40
+search_api_cache_timeout = 60 * 5
+
+# Store the search text for each page zlib compressed?  Compressed text takes
+# roughly a third of the space in the database, but the database can no longer
+# filter the pages: every search loads and decompresses the search text of
+# every page.  Only use it for small documents, or when database space is
+# scarce.  Run ``python manage.py rebuild_search_text`` after changing this
+# setting.
+compress_search_text = False
+
+# Publishing runs in the background.  A publish job that has been running for
+# longer than ``publish_job_timeout`` seconds is assumed to have died (e.g. the
+# web server was restarted), and no longer blocks a new publish.
+publish_job_timeout = 60 * 60
+
+# Number of processes Sphinx may use to read the RST files while publishing
+# (only used with Sphinx 1.3 or newer).  Reading large documents is faster
+# on a multi-core server with more processes.
+publish_parallel = 1
+
+# Profile each publish with cProfile?  The slowest functions are added to the
+# publish job's report (see the ``PublishJob`` pages in the Django admin).  The
+# time taken by each phase is always reported.
+publish_profile = False
+
+# Unused comment references (never commented on, and no longer on any page)
+# are removed by ``manage.py cleanup_references`` once they were last published
+# more than ``reference_retention_days`` ago.  They are deleted in batches of
+# ``reference_gc_batch_size`` references.
+reference_retention_days = 365
+reference_gc_batch_size = 1000
+
 # Document splitting (experimental !)
 # ------------------
 
@@ -317,6 +363,11 @@ skip_nodes_in = ['contents']
 # writable by the webserver.
 comment_compile_area = application_path + 'comment_compile_area'
 
+# Images (equations) in previewed comments that were never submitted are
+# removed by ``manage.py cleanup_comment_images`` once they are older than this
+# many hours.  Images used by comments are never removed.
+comment_image_ttl_hours = 48
+
 # Email and message settings
 # ---------------------------
 
@@ -14,6 +14,7 @@ hg_verbs = {'pull':   ['pull',    {}],
             'commit': ['commit',  {1: 'Nothing changed'}],
             'push':   ['push',    {}],
             'summary':['summary', {0: '<string>'}],  # return stdout
+            'status': ['status',  {0: '<string>'}],  # return stdout
             }
 
 # Can be overridden by the module that calls this module, i.e. in ``views.py``:
@@ -104,6 +105,27 @@ def get_revision_info(remote=False):
     source = output.split('\n')[0].split(':')
     return source[2].split()[0]
 
+def changed_files(rev_from, rev_to='tip'):
+    """
+    Returns a list of ``(status, file_name)`` tuples for the files that changed
+    in the local repository between revisions ``rev_from`` and ``rev_to``.
+    The ``status`` is a letter, as for ``hg status``: e.g. M = modified,
+    A = added, R = removed.  File names are relative to the repository root.
+    """
+    output = _run_hg_command(['status', '--rev', str(rev_from),
+                              '--rev', str(rev_to)])
+    if not isinstance(output, basestring):
+        if isinstance(output, list):
+            output = ''.join(output).strip()
+        raise DVCSError('Could not compare revision %s with %s: %s' % \
+                        (rev_from, rev_to, output))
+    changes = []
+    for line in output.splitlines():
+        status, _, file_name = line.partition(' ')
+        if file_name:
+            changes.append((status, file_name))
+    return changes
+
 def init(dest):
     """
     Creates a repository in the destination directory, ``dest``.
@@ -0,0 +1,34 @@
+"""
+Removes the equation images of comments that were previewed, but never
+submitted.  Run it periodically, for example from a daily cron job::
+
+    python manage.py cleanup_comment_images --hours=48
+"""
+import sys
+from optparse import make_option
+from django.core.management.base import BaseCommand
+
+from conf import settings as conf
+import views
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--hours', type='int', dest='hours',
+                    default=conf.comment_image_ttl_hours,
+                    help=('Only remove unused images written more than this '
+                          'many hours ago.')),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help='Report what would be removed, without deleting.'),
+    )
+    help = 'Deletes comment images that are not used by any comment.'
+
+    def handle(self, *args, **options):
+        report = views.sweep_comment_images(ttl_hours=options['hours'],
+                                            dry_run=options['dry_run'])
+        if options['dry_run']:
+            sys.stdout.write('Would remove %d comment images; keep %d.\n' % \
+                             (report['removed'], report['kept']))
+        else:
+            sys.stdout.write(('Removed %(removed)d comment images; kept '
+                              '%(kept)d.\n') % report)
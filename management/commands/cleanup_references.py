@@ -0,0 +1,44 @@
+"""
+Removes the unused comment references from the database.  Run it periodically,
+for example from a monthly cron job::
+
+    python manage.py cleanup_references --days=365
+"""
+import sys
+from optparse import make_option
+from django.core.management.base import BaseCommand
+
+from conf import settings as conf
+import views
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', dest='days',
+                    default=conf.reference_retention_days,
+                    help=('Only remove references last published more than '
+                          'this many days ago.')),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=conf.reference_gc_batch_size,
+                    help='Number of references deleted in each transaction.'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help='Report what would be removed, without deleting.'),
+    )
+    help = ('Deletes comment references that were never commented on and no '
+            'longer appear on any page.')
+
+    def handle(self, *args, **options):
+        report = views.collect_unused_references(
+                                    retention_days=options['days'],
+                                    batch_size=options['batch_size'],
+                                    dry_run=options['dry_run'])
+        if options['dry_run']:
+            sys.stdout.write('Would remove %d of %d comment references.\n' % \
+                             (report['removed'], report['before']))
+        else:
+            sys.stdout.write(('Removed %(removed)d comment references: '
+                              '%(before)d before, %(after)d after.\n') % report)
+        if report['size_before'] is not None:
+            sys.stdout.write(('Table size: %d kB before, %d kB after.\n') % \
+                             (report['size_before'] // 1024,
+                              report['size_after'] // 1024))
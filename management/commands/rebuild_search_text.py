@@ -0,0 +1,46 @@
+"""
+Fills in the search text of pages published by an earlier version of this
+application, and (de)compresses it after ``compress_search_text`` is changed::
+
+    python manage.py rebuild_search_text
+
+When upgrading from a version that stored the search text in the page table,
+do these steps in this order:
+
+1. Deploy this version and run ``python manage.py syncdb``.
+2. Run ``python manage.py rebuild_search_text``: it reads the old column.
+3. Drop the ``search_text`` column of the page table.  Until it is dropped, new
+   pages cannot be published.
+"""
+import sys
+from optparse import make_option
+from django.core.management.base import BaseCommand
+
+import views
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help='Report what would be changed, without saving.'),
+    )
+    help = ('Creates the missing search text for published pages, and stores '
+            'it (un)compressed as the settings require.  When upgrading, run '
+            'it after syncdb, but before dropping the old search_text column '
+            'of the page table.')
+
+    def handle(self, *args, **options):
+        report = views.rebuild_search_text(dry_run=options['dry_run'])
+        if options['dry_run']:
+            sys.stdout.write(('Would create %(created)d and convert '
+                              '%(converted)d search texts.\n') % report)
+        else:
+            sys.stdout.write(('Created %(created)d and converted %(converted)d '
+                              'search texts.\n') % report)
+        if report['missing']:
+            sys.stdout.write(('%d pages have no search text: republish every '
+                              'page to create it.\n') % report['missing'])
+        if report['old_column'] and not options['dry_run']:
+            sys.stdout.write(('Now drop the old search_text column of the page '
+                              'table: new pages cannot be published until it '
+                              'is dropped.\n'))
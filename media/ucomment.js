@@ -93,6 +93,12 @@ var XHR_COMMENT_HTML = URL_VIEWS_PREFIX + '_retrieve-comments/';
 // The location (last part of URL) used to search document (must match with the
 // ``search_document`` function specific in Django's urls.py file)
 var URL_SEARCH_DOCUMENT = URL_VIEWS_PREFIX + '_search/';
+// The location (last part of URL) used for the instant search results, shown
+// as the user types (must match with the ``search_api`` function specific in
+// Django's urls.py file)
+var XHR_SEARCH_API = URL_VIEWS_PREFIX + '_search-api/';
+// Wait this many milliseconds after the last keypress before searching
+var INSTANT_SEARCH_DELAY = 250;
 
 
 // Comment block: one block for each element that can be commented
@@ -355,6 +361,50 @@ var make_XHR_commment_count_request = function () {
 	var request = Y.io(sURI + XHR_COMMENT_COUNTS, cfgcounts);
 };
 
+// Instant search: the results are shown below the search box as the user types
+var instant_search_timer = null;
+var instant_search_last = '';
+var show_instant_search_results = function(id, o){
+	var container = Y.one('#ucomment-instant-search');
+	var response = Y.JSON.parse(o.responseText);
+	if (response.query !== instant_search_last){
+		return;  // the user has typed further in the mean time
+	}
+	var out = '';
+	for (var i=0; i<response.results.length; i++){
+		var result = response.results[i];
+		out += '<li><a href="' + result.link + '?highlight=' +
+		       encodeURIComponent(response.query) + '">' + result.title +
+		       '</a><div>' + result.snippet + '</div></li>';
+	}
+	if (response.total > response.results.length){
+		out += '<li class="ucomment-instant-search-more">Press Enter to ' +
+		       'see all ' + response.total + ' results</li>';
+	}
+	container.set('innerHTML', out ? '<ul>' + out + '</ul>' : '');
+	container.setStyle('display', out ? 'block' : 'none');
+};
+var make_XHR_search_request = function(){
+	var query = Y.Lang.trim(Y.one('#ucomment-search-box').get('value'));
+	if (query === instant_search_last){
+		return;
+	}
+	instant_search_last = query;
+	if (query.length < 3){
+		Y.one('#ucomment-instant-search').setStyle('display', 'none');
+		return;
+	}
+	Y.io(sURI + XHR_SEARCH_API + '?q=' + encodeURIComponent(query),
+	     {method: 'GET', on: {success: show_instant_search_results}});
+};
+var instant_search = function(e){
+	if (instant_search_timer){
+		instant_search_timer.cancel();
+	}
+	instant_search_timer = Y.later(INSTANT_SEARCH_DELAY, null,
+	                               make_XHR_search_request);
+};
+
 var change_tabs = function (e){
 	var tabref = e.target.get('href');
 	var which_tab = tabref.substring(tabref.indexOf('#'));
@@ -463,6 +513,12 @@ var initialize = function() {
 	// Change the URL for the search form
 	Y.one('#ucomment-search-form').set('action', sURI + URL_SEARCH_DOCUMENT);
 
+	// Container for the instant search results, shown below the search box
+	Y.one('#ucomment-search-form').append(
+		Y.Node.create('<div id="ucomment-instant-search"></div>'));
+	Y.one('#ucomment-instant-search').setStyle('display', 'none');
+	Y.on('keyup', instant_search, '#ucomment-search-box');
+
 	// We set the left edge according to this element
 	chapterWrapper = Y.one('#ucomment-content-main');
 
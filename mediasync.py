@@ -0,0 +1,135 @@
+"""
+Keeps a directory of media files (e.g. images) for the webserver in sync with
+the directory where Sphinx creates them.
+
+Only new and changed files are transferred: they are hard linked when both
+directories are on the same file system, and copied otherwise.  Files that
+are no longer in the source directory can also be removed.
+"""
+# Name of the file, in the destination directory, that records the files that
+# were transferred there: relative file name -> (size, modification time, hash)
+# of the source file.
+MANIFEST_NAME = '.ucomment-manifest'
+
+import os, shutil, pickle
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+def file_hash(filename, block_size=65536):
+    """ Returns the md5 hash of the contents of ``filename``."""
+    digest = md5()
+    with open(filename, 'rb') as f_handle:
+        block = f_handle.read(block_size)
+        while block:
+            digest.update(block)
+            block = f_handle.read(block_size)
+    return digest.hexdigest()
+
+def load_manifest(dst_dir, name=MANIFEST_NAME):
+    """
+    Returns the manifest of directory ``dst_dir``.  It is empty if there is
+    none, or if it cannot be read (e.g. a truncated file): then every file is
+    checked again.
+    """
+    try:
+        with open(os.path.join(dst_dir, name), 'rb') as f_handle:
+            manifest = pickle.load(f_handle)
+    except Exception:
+        # A damaged pickle can raise almost any exception while loading
+        return {}
+    if not isinstance(manifest, dict):
+        return {}
+    return manifest
+
+def save_manifest(dst_dir, manifest, name=MANIFEST_NAME):
+    """ Writes the ``manifest`` of directory ``dst_dir``."""
+    filename = os.path.join(dst_dir, name)
+    with open(filename + '.tmp', 'wb') as f_handle:
+        pickle.dump(manifest, f_handle, 2)
+    os.rename(filename + '.tmp', filename)
+
+def link_or_copy(src, dst):
+    """
+    Hard links file ``src`` to ``dst``, replacing any existing ``dst``; the
+    file is copied if it cannot be linked, e.g. across file systems.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except (OSError, AttributeError):  # AttributeError: no os.link on Windows
+        shutil.copy2(src, dst)
+
+def store_by_hash(src, dst_dir):
+    """
+    Transfers file ``src`` to ``dst_dir``, named by the hash of its contents
+    (with the same extension), and returns the new name.  The file is only
+    transferred if it is not there yet, and always appears complete: it is
+    transferred to a temporary file, which is then renamed.  Otherwise the
+    modification time of the existing file is refreshed.
+    """
+    name = file_hash(src) + os.path.splitext(src)[1]
+    dst = os.path.join(dst_dir, name)
+    if os.path.exists(dst):
+        os.utime(dst, None)
+    else:
+        link_or_copy(src, dst + '.tmp')
+        os.rename(dst + '.tmp', dst)
+    return name
+
+def sync_directory(src_dir, dst_dir, remove=True):
+    """
+    Transfers the files in ``src_dir``, and its sub-directories, to
+    ``dst_dir``.  A file is only transferred if it is new, or its contents
+    have changed since it was last transferred; the hash of a source file is
+    only calculated if its size or modification time changed.
+
+    If ``remove`` is True, then files transferred previously, but no longer in
+    ``src_dir``, are removed from ``dst_dir``.  Other files in ``dst_dir`` are
+    never touched.
+
+    Returns a dictionary with the number of files ``copied``, ``removed`` and
+    ``unchanged``.
+    """
+    if not os.path.isdir(dst_dir):
+        os.makedirs(dst_dir)
+    manifest = load_manifest(dst_dir)
+    new_manifest = {}
+    counts = {'copied': 0, 'removed': 0, 'unchanged': 0}
+    for root, dirs, files in os.walk(src_dir):
+        for name in files:
+            src = os.path.join(root, name)
+            rel_name = os.path.relpath(src, src_dir)
+            dst = os.path.join(dst_dir, rel_name)
+            stat = os.stat(src)
+            entry = manifest.get(rel_name)
+            if entry and entry[0:2] == (stat.st_size, stat.st_mtime) and \
+                                                            os.path.exists(dst):
+                new_manifest[rel_name] = entry
+                counts['unchanged'] += 1
+                continue
+
+            digest = file_hash(src)
+            if entry and entry[2] == digest and os.path.exists(dst):
+                counts['unchanged'] += 1
+            else:
+                if not os.path.isdir(os.path.dirname(dst)):
+                    os.makedirs(os.path.dirname(dst))
+                link_or_copy(src, dst)
+                counts['copied'] += 1
+            new_manifest[rel_name] = (stat.st_size, stat.st_mtime, digest)
+
+    for rel_name in set(manifest) - set(new_manifest):
+        if remove:
+            dst = os.path.join(dst_dir, rel_name)
+            if os.path.lexists(dst):
+                os.remove(dst)
+                counts['removed'] += 1
+        else:
+            new_manifest[rel_name] = manifest[rel_name]
+
+    if new_manifest != manifest:
+        save_manifest(dst_dir, new_manifest)
+    return counts
@@ -2,6 +2,7 @@
     :copyright: Copyright 2010, by Kevin Dunn
     :license: BSD, see LICENSE file for details.
 """
+import zlib, base64, datetime
 from django.db import models
 from django.conf import settings
 from django.utils import text
@@ -85,8 +86,11 @@ class Page(models.Model):
     number_of_HTML_visits = models.PositiveIntegerField(default=0)
     # The HTML served to the user
     body = models.TextField()
-    # Cleaner equivalent of the HTML (used for Sphinx Search)
-    search_text = models.TextField()
+    # MD5 hash of the page's Sphinx output and RST source when last published:
+    # unchanged pages are skipped when publishing.
+    content_hash = models.CharField(max_length=32, blank=True)
+    # The cleaner equivalent of the HTML, used for searching, is stored in
+    # ``PageSearchText``, and accessed as ``page.search``
     # Links related to this page
     parent_link = models.ForeignKey('Link', related_name='parent', blank=True,
                                     null=True,)
@@ -113,6 +117,84 @@ class Page(models.Model):
     class Meta:
         unique_together = (('link_name', ),)
 
+class PageSearchText(models.Model):
+    """
+    The cleaned RST source of a ``Page``, used only when searching the
+    document.  It is kept in its own table so that the (large) search text is
+    never loaded when displaying pages.
+
+    If ``conf.compress_search_text`` is True, then the text is stored zlib
+    compressed (base64 encoded, to fit in a text field): always use
+    ``get_text()`` and ``set_text()``, rather than the ``text`` field.
+    """
+    page = models.OneToOneField('Page', related_name='search')
+    is_compressed = models.BooleanField(default=False)
+    text = models.TextField(blank=True)
+
+    def get_text(self):
+        """ Returns the (uncompressed) search text, as a unicode string."""
+        if self.is_compressed:
+            return zlib.decompress(base64.b64decode(self.text)).decode('utf-8')
+        else:
+            return self.text
+
+    def set_text(self, text):
+        """ Sets the search text, compressing it if required."""
+        if conf.compress_search_text and text:
+            if isinstance(text, unicode):
+                text = text.encode('utf-8')
+            self.text = base64.b64encode(zlib.compress(text, 9))
+            self.is_compressed = True
+        else:
+            self.text = text
+            self.is_compressed = False
+
+    def __unicode__(self):
+        return u'Search text for page %i' % self.page_id
+
+class PublishJob(models.Model):
+    """
+    A (re)publish of the document, which runs in the background.  The job's
+    progress is updated as it runs, so that the author can follow it.
+    """
+    STATUS_CHOICES = (('queued', 'Queued'),
+                      ('running', 'Running'),
+                      ('succeeded', 'Succeeded'),
+                      ('failed', 'Failed'))
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES,
+                              default='queued')
+    # A full (forced) publish, or only the changed pages?
+    force = models.BooleanField(default=False)
+    # The phase of the publishing: e.g. "compiling", "saving pages"
+    phase = models.CharField(max_length=100, blank=True)
+    pages_processed = models.PositiveIntegerField(default=0)
+    pages_total = models.PositiveIntegerField(default=0)
+    # Warnings from Sphinx, one per line
+    warnings = models.TextField(blank=True)
+    started_on = models.DateTimeField(auto_now_add=True)
+    finished_on = models.DateTimeField(null=True, blank=True)
+    # Mercurial changeset that was published
+    revision_changeset = models.CharField(max_length=50, blank=True)
+    # Fingerprint of the settings the document was published with: see
+    # ``views.publish_fingerprint``
+    settings_hash = models.CharField(max_length=32, blank=True)
+    # The outcome of the job: empty if it succeeded, else the error message
+    message = models.TextField(blank=True)
+    # Time taken by each phase of the publish, and the number of pages and
+    # comment references published (and a profile, if requested)
+    report = models.TextField(blank=True)
+
+    def elapsed(self):
+        """ Returns the number of seconds the job has taken (so far)."""
+        finished_on = self.finished_on or datetime.datetime.now()
+        elapsed = finished_on - self.started_on
+        return elapsed.days * 86400 + elapsed.seconds + \
+                                            elapsed.microseconds / 1E6
+
+    def __unicode__(self):
+        return u'Publish job %i: %s [%s]' % (self.pk, self.status,
+                                             str(self.started_on)[0:19])
+
 class Hit(models.Model):
     """
     Tracks page hits
@@ -18,9 +18,7 @@ import os
 import re
 import sys
 import time
-import random
 import shutil
-import subprocess
 import collections
 try:
     from hashlib import md5
@@ -56,9 +54,69 @@ CLASS_NAME = 'ucomment'
 CommentReference = collections.namedtuple('CommentReference',
                                           'source node line root link_name')
 
+# What one scan of an RST source file finds (see ``scan_source_file``).  They
+# are saved between builds as plain tuples, in ``conf['source_summaries']``.
+SourceSummary = collections.namedtuple('SourceSummary', ('mtime size '
+                            'content_hash dividers has_toctree roots'))
+# To find the comment roots already used in the RST source
+UCOMMENT_LINE_RE = re.compile(r'^\s*\.\. ucomment::\s*(.*?):')
+# Lines of the source files read during this build, so that each file is read
+# at most once.  Emptied at the start and end of ``builder-inited``.
+source_lines = {}
+
+# Finds the directive that created nodes whose line number is not known to
+# docutils: see ``find_unusual_line_number``.
+DIRECTIVE_RE = {
+    'image': re.compile(r'(\s*)\.\. ((image)|(figure))::'),
+    'sidebar': re.compile(r'(\s*)\.\. (sidebar)::'),
+    # http://docutils.sourceforge.net/docs/ref/rst/directives.html#tables
+    # ``tabularcolumns`` is a Sphinx directive: /sphinx/directives/other.py
+    'table': re.compile(r'(\s*)\.\. ((table)|(csv-table)|(list-table))::'),
+}
+# The first row of a grid or simple table: ===== or +-----
+TABLE_ROW_RE = re.compile(r'(={2,})|(\+-{2,})')
+
+# The docutils parser and settings used to read toctree directives, and the
+# files found in each toctree: see ``get_documents_in_toctree``.
+toctree_cache = {}
+
 #-------------------------------------------------------------------------------
 # Utility function
 #-------------------------------------------------------------------------------
+class SourceLineCache(object):
+    """
+    The lines of the most recently used source files, shared by the translators
+    while the HTML is written.  Files are keyed by name and modification time;
+    the least recently used file is dropped once ``size`` files are cached.
+    """
+    def __init__(self, size=32):
+        self.size = size
+        self.files = {}   # file name -> (modification time, lines)
+        self.order = []   # file names, least recently used first
+
+    def lines(self, name):
+        """ Returns the list of lines in the file ``name``."""
+        mtime = os.stat(name).st_mtime
+        entry = self.files.get(name)
+        if entry is None or entry[0] != mtime:
+            with open(name, 'r') as file_handle:
+                entry = (mtime, file_handle.readlines())
+            self.files[name] = entry
+        if name in self.order:
+            self.order.remove(name)
+        self.order.append(name)
+        while len(self.order) > self.size:
+            del self.files[self.order.pop(0)]
+        return entry[1]
+
+    def clear(self):
+        """ Empties the cache."""
+        self.files.clear()
+        del self.order[:]
+
+# Emptied for every build, in ``ucomment_builder_init_function``
+source_line_cache = SourceLineCache()
+
 def make_title(line):
     """ Makes a suitable filename from the section's title (slugify).
 
@@ -68,14 +126,33 @@ def make_title(line):
     """
     return nodes.make_id(line)
 
-def create_codes_ID(num):
+def create_codes_ID(num, *parts):
     """Creates a new comment identifier; these appear in the source code for
     each page; they must be short and not possible to cause confusion.
 
+    The identifier is calculated from the hash of ``parts`` (the document,
+    node type and the node's content), so an unchanged node is given the same
+    identifier every time the document is compiled.
+
     53 characters, N=4 combinations = 53^4 = many comment ID's (prevents collisions)
     """
     valid_letters = 'abcdefghjkmnpqrstuvwxyzABCEFGHJKLMNPQRSTUVWXY23456789'
-    return ''.join([random.choice(valid_letters) for i in range(num)])
+    parts = [isinstance(part, unicode) and part.encode('utf-8') or str(part)
+             for part in parts]
+    value = int(md5('\0'.join(parts)).hexdigest(), 16)
+    letters = []
+    for i in range(num):
+        value, idx = divmod(value, len(valid_letters))
+        letters.append(valid_letters[idx])
+    return ''.join(letters)
+
+def node_fingerprint(node):
+    """
+    Returns a fingerprint of the content of ``node``: its text, with the white
+    space normalized, and the image's URI for images.  Nodes keep the same
+    fingerprint when text is added or removed elsewhere in the file.
+    """
+    return u' '.join(node.astext().split()) + u'\0' + node.get('uri', u'')
 
 #-------------------------------------------------------------------------------
 # Subclass the HTML translator to appropriately handle ``ucomment`` directives.
@@ -84,44 +161,42 @@ class ucomment_html_translator(SmartyPantsHTMLTranslator):
     """
     Subclasses the HTML translator, so that we can add a few custom methods
     to help with the commenting.
+
+    A translator is created for every document that is written, so the work
+    that is the same for every document is done once per build, in
+    ``ucomment_builder_init_function``.
     """
+    # The parent's methods, called after the ucomment attributes are added
+    parent = SmartyPantsHTMLTranslator
+    visit_title_original = staticmethod(parent.visit_title)
+    visit_figure_original = staticmethod(parent.visit_figure)
+    visit_image_original = staticmethod(parent.visit_image)
+    visit_sidebar_original = staticmethod(parent.visit_sidebar)
+    visit_literal_block_original = staticmethod(parent.visit_literal_block)
+    visit_list_item_original = staticmethod(parent.visit_list_item)
+    visit_term_original = staticmethod(parent.visit_term)
+    visit_table_original = staticmethod(parent.visit_table)
+    depart_table_original = staticmethod(parent.depart_table)
+    try:
+        visit_displaymath_original = staticmethod(parent.visit_displaymath)
+    except AttributeError:
+        from sphinx.ext.pngmath import html_visit_displaymath
+        visit_displaymath_original = staticmethod(html_visit_displaymath)
+        del html_visit_displaymath
+    del parent
+
     def __init__(self, *args, **kwds):
         SmartyPantsHTMLTranslator.__init__(self, *args, **kwds)
-        parent = SmartyPantsHTMLTranslator
-        self.visit_title_original = parent.visit_title
-        self.visit_figure_original = parent.visit_figure
-        self.visit_image_original = parent.visit_image
-        self.visit_sidebar_original = parent.visit_sidebar
-        self.visit_literal_block_original = parent.visit_literal_block
-        self.visit_list_item_original = parent.visit_list_item
-        self.visit_term_original = parent.visit_term
-        self.visit_table_original = parent.visit_table
-        self.depart_table_original = parent.depart_table
-        self.in_admonition_title = False
-
-        try:
-            self.visit_displaymath_original = parent.visit_displaymath
-        except AttributeError:
-            from sphinx.ext.pngmath import html_visit_displaymath
-            self.visit_displaymath_original = html_visit_displaymath
-
-        # TODO(KGD): this code is being called for every document
-        #            Find a signal that is emitted where this code can
-        #            be called just once.
         self.ucomment = self.builder.app.env.config['ucomment']
-        self.ucomment['skip_nodes_in'].add(u'<partial node>')
-        self.ucomment['line_offset'] = {}
-        self.ucomment['last_line'] = -1
 
-        for srcname, fileoffsets in self.ucomment['split_files'].iteritems():
-            if len(fileoffsets) > 1:
-                new_files = dict((v, k) for k, v in fileoffsets.iteritems())
-                self.ucomment['line_offset'].update(new_files)
-            elif len(fileoffsets) == 1:
-                self.ucomment['line_offset'][srcname] = fileoffsets.keys()[0]
-            elif len(fileoffsets) == 0:
-                self.ucomment['line_offset'][srcname] = 0
+        # The line offset of each (split) file in its RST source file: shared
+        # by all translators, and must not be changed.
+        self.line_offset = self.ucomment['line_offsets']
 
+        # The state for the current document is kept in the translator, not in
+        # the shared ``ucomment`` settings.
+        self.last_line = -1
+        self.in_admonition_title = False
 
         # Is ``True`` when we are dealing with entries in a table
         self.within_table = False
@@ -160,7 +235,7 @@ class ucomment_html_translator(SmartyPantsHTMLTranslator):
                 if node.parent.children[preceding_sibling].line is not None:
                     lower_bound = node.parent.children[preceding_sibling].line
 
-            lower_bound = max(self.ucomment['last_line'], lower_bound)
+            lower_bound = max(self.last_line, lower_bound)
 
             # Last resort
             try:
@@ -201,17 +276,16 @@ class ucomment_html_translator(SmartyPantsHTMLTranslator):
 
         # At this point we give up: this node won't be commentable
 
-    def find_unusual_line_number(self, node, regex):
+    def find_unusual_line_number(self, node, directive):
         """
         Do a bit more work in finding the line numbers for these nodes:
-        open up the source file and search more carefully for the directive.
+        open up the source file and search more carefully for the directive,
+        one of the entries in ``DIRECTIVE_RE``.
 
         The side effect of this function is that it will adjust ``node.line``.
         """
-        with open(node.source, 'r') as filesrc:
-            lines = filesrc.readlines()
-
-        valid = re.compile(r'(\s*)\.\. (' + regex + r')::')
+        lines = source_line_cache.lines(node.source)
+        valid = DIRECTIVE_RE[directive]
         for idx, line in enumerate(lines[node.line_lower-1:node.line_upper]):
             if valid.match(line):
                 # Found the desired starting point for the node.
@@ -220,10 +294,19 @@ class ucomment_html_translator(SmartyPantsHTMLTranslator):
 
         return False
 
-    def discover_comment(self, node):
+    def discover_comment(self, node, docname, node_type):
         """ Finds a comment close to the current node that refers to the content
         in ``node``. If a comment is found, this function will return that
         comment's root, else it will create a new comment_root to return.
+
+        New roots are calculated from the node's ``docname`` (the split file,
+        so identical nodes in sections of the same RST file differ), its
+        ``node_type`` and content (see ``node_fingerprint``), so a node keeps
+        its root, and its comment reference, for as long as it is unchanged.
+        If that root is already used, e.g. by an identical node, or by a
+        comment reference in the database for another page (which might not
+        be rewritten in this build), a counter is added until an unused root
+        is found.
         """
         # Special case: ``list_item`` nodes have their comment as children
         if node.tagname == 'list_item':
@@ -239,12 +322,21 @@ class ucomment_html_translator(SmartyPantsHTMLTranslator):
             comment = node
 
         if comment.tagname != CLASS_NAME:
-            comment_root = create_codes_ID(self.ucomment['root_node_length'])
-            while comment_root in self.ucomment['used_roots']:
+            used_roots = self.ucomment['used_roots']
+            reference_roots = self.ucomment['reference_roots']
+            fingerprint = node_fingerprint(node)
+            collisions = 0
+            comment_root = create_codes_ID(self.ucomment['root_node_length'],
+                                           docname, node_type, fingerprint)
+            while comment_root in used_roots or \
+                    reference_roots.get(comment_root, docname) != docname:
+                collisions += 1
                 comment_root = create_codes_ID( \
-                                            self.ucomment['root_node_length'])
-            # Add it to the list of used roots
-            self.ucomment['used_roots'].append(comment_root)
+                                        self.ucomment['root_node_length'],
+                                        docname, node_type, fingerprint,
+                                        collisions)
+            # Add it to the set of used roots
+            used_roots.add(comment_root)
         else:
             comment_root = comment.ucomment_root
             comment.been_handled = True
@@ -281,24 +373,24 @@ class ucomment_html_translator(SmartyPantsHTMLTranslator):
             if src not in self.ucomment['skip_nodes_in']:
 
                 # Collect information about the comment reference.
-                comment_root = self.discover_comment(node)
-                self.ucomment['last_line'] = node.line
-                line_number = node.line + self.ucomment['line_offset'][src]
-
-                node.attributes['ids'] = [comment_root]
-                node.attributes['classes'].extend([CLASS_NAME])
-
-                # Append the info to later create the comment references in the
-                # database.
+                line_number = node.line + self.line_offset[src]
                 node_type = node.tagname
                 if node.parent.tagname == 'list_item':
                     node.parent._ucomment_num_nodes += 1
                     if node.parent._ucomment_num_nodes == 1:
                         # Only the first node is marked as a list item
                         node_type = 'list_item'
+                source = self.ucomment['split_sources'][node.source]
+                comment_root = self.discover_comment(node, src, node_type)
+                self.last_line = node.line
+
+                node.attributes['ids'] = [comment_root]
+                node.attributes['classes'].extend([CLASS_NAME])
 
+                # Append the info to later create the comment references in the
+                # database.
                 self.ucomment['comment_refs'].append(CommentReference(
-                                self.ucomment['split_sources'][node.source],
+                                source,
                                 node_type,
                                 line_number,
                                 comment_root,
@@ -315,7 +407,7 @@ class ucomment_html_translator(SmartyPantsHTMLTranslator):
         #       at the moment (ver 0.7).  We will access it reading the source
         #       file ourselves and finding the image or figure directive.
         self.discover_line_and_source(node, bias=0, bias_if_present=0)
-        self.find_unusual_line_number(node, regex = r'(image)|(figure)')
+        self.find_unusual_line_number(node, 'image')
         self.extend_node_attrs(node, bias=0)
         self.visit_image_original(self, node)
 
@@ -342,7 +434,7 @@ class ucomment_html_translator(SmartyPantsHTMLTranslator):
         the line number (maybe we can find a way to comment on them in future?)
         """
         self.discover_line_and_source(node, bias=0, bias_if_present=0)
-        self.find_unusual_line_number(node, regex = r'sidebar')
+        self.find_unusual_line_number(node, 'sidebar')
         self.visit_sidebar_original(self, node)
 
 
@@ -437,22 +529,16 @@ class ucomment_html_translator(SmartyPantsHTMLTranslator):
         """
         self.discover_line_and_source(node, bias=0, bias_if_present=0)
 
-        # http://docutils.sourceforge.net/docs/ref/rst/directives.html#tables
-        # ``tabularcolumns`` is a Sphinx directive: /sphinx/directives/other.py
-        table_regex = r'(table)|(csv-table)|(list-table)'
-
         # Note: the logical test has a side effect: it sets ``node.line``
-        if not self.find_unusual_line_number(node, regex = table_regex):
+        if not self.find_unusual_line_number(node, 'table'):
             # Search again: Maybe it is a simple table or a grid table.
-            with open(node.source, 'r') as filesrc:
-                sc = filesrc.readlines()
+            sc = source_line_cache.lines(node.source)
 
             # Search for: ===== or +----- :
             # http://docutils.sourceforge.net/docs/ref/rst/restructuredtext.html
             # See the "Grid tables" and "Simple tables" section
-            table_row = re.compile(r'(={2,})|(\+-{2,})')
             for idx, line in enumerate(sc[node.line_lower-1:node.line_upper]):
-                if table_row.match(line):
+                if TABLE_ROW_RE.match(line):
                     # Found the desired starting point for the node.
                     node.line = idx + node.line_lower
                     break
@@ -574,6 +660,11 @@ class ucomment_directive(Directive):
         node.been_handled = False
         node.line = self.lineno
 
+        # Record the root against the document being read: the environment
+        # keeps this per-document state (see ``ucomment_env_merge_info``).
+        env = self.state.document.settings.env
+        env.ucomment_roots.setdefault(env.docname, set()).add(
+                                                            node.ucomment_root)
         return [node]
 
 def get_documents_in_toctree(toctree_lines, found_docs, docname):
@@ -592,29 +683,140 @@ def get_documents_in_toctree(toctree_lines, found_docs, docname):
     the Sphinx ``.. toctree::`` directive.  But it is better this way, because
     if Sphinx changes its toctree syntax, then we will still get the correct
     list of files.
+
+    The parser and its settings are only created once, and the result for each
+    toctree is remembered, for as long as ``found_docs`` does not change.
     """
-    directives.register_directive('toctree', TocTree)
-    parser = Parser()
     source = ''.join(toctree_lines)
-
-    # Simulate the Sphinx environment entries required
-    config = collections.namedtuple('config', 'source_suffix')
-    config.source_suffix = 'rst'
-    fake_sphinx_env = collections.namedtuple('env', 'config found_docs docname')
-    fake_sphinx_env.config = config
-    fake_sphinx_env.found_docs = found_docs
-    fake_sphinx_env.docname = docname
-
-    # Create a settings variable for docutils.
-    settings = OptionParser(defaults={
-                    'tab_width': 8,
-                    'pep_references': '',
-                    'rfc_references': '',
-                    'env': fake_sphinx_env}).get_default_values()
+    found_docs = frozenset(found_docs)
+    if toctree_cache.get('found_docs') != found_docs:
+        toctree_cache['found_docs'] = found_docs
+        toctree_cache['results'] = {}
+    key = (source, docname)
+    if key in toctree_cache['results']:
+        return list(toctree_cache['results'][key])
+
+    if 'parser' not in toctree_cache:
+        directives.register_directive('toctree', TocTree)
+        toctree_cache['parser'] = Parser()
+
+        # Simulate the Sphinx environment entries required
+        config = collections.namedtuple('config', 'source_suffix')
+        config.source_suffix = 'rst'
+        fake_sphinx_env = collections.namedtuple('env',
+                                                 'config found_docs docname')
+        fake_sphinx_env.config = config
+
+        # Create a settings variable for docutils.
+        toctree_cache['settings'] = OptionParser(defaults={
+                        'tab_width': 8,
+                        'pep_references': '',
+                        'rfc_references': '',
+                        'env': fake_sphinx_env}).get_default_values()
+
+    settings = toctree_cache['settings']
+    settings.env.found_docs = found_docs
+    settings.env.docname = docname
 
     document = new_document('<toctree directive>', settings)
-    parser.parse(source, document)
-    return document.children[0].children[0].attributes.get('includefiles', [])
+    toctree_cache['parser'].parse(source, document)
+    result = document.children[0].children[0].attributes.get('includefiles',
+                                                             [])
+    toctree_cache['results'][key] = tuple(result)
+    return list(result)
+
+def read_source_lines(fullname):
+    """
+    Returns the list of lines in the file ``fullname``; the file is only read
+    once during the ``builder-inited`` stage.
+    """
+    if fullname not in source_lines:
+        with open(fullname, 'r') as file_handle:
+            source_lines[fullname] = file_handle.readlines()
+    return source_lines[fullname]
+
+def scan_source_file(fullname, conf, div_re):
+    """
+    Returns the ``SourceSummary`` of the RST source file ``fullname``: the line
+    offsets above each major section divider (lines matching ``div_re``),
+    whether it has a toctree directive, the comment roots used in it, and the
+    hash of its contents.
+
+    The summary is saved in ``conf['source_summaries']`` and only recalculated
+    once the file's modification time or size has changed.
+    """
+    stat = os.stat(fullname)
+    cached = conf['source_summaries'].get(fullname)
+    if cached and cached[0:2] == (stat.st_mtime, stat.st_size):
+        return SourceSummary(*cached)
+
+    lines = read_source_lines(fullname)
+    dividers = []
+    roots = []
+    has_toctree = False
+    for idx, line in enumerate(lines):
+        if div_re.search(line.rstrip()):
+            dividers.append(idx-1)
+        toctree = TOCTREE_RE.match(line)
+        # Minor defect: we can't handle cases when the text ``.. toctree:: ``
+        # is used in a document.  So we will ignore this directive as long as
+        # it is away from the left edge of the page: it isn't really a
+        # toctree.  Occurs when one is documenting the toctree directive,
+        # e.g. showing it in source code.
+        if toctree and len(toctree.group(1).expandtabs()) == 0:
+            has_toctree = True
+        has_ucomment = UCOMMENT_LINE_RE.match(line)
+        if has_ucomment:
+            roots.append(has_ucomment.group(1))
+
+    summary = SourceSummary(stat.st_mtime, stat.st_size,
+                            md5(''.join(lines)).hexdigest(), tuple(dividers),
+                            has_toctree, tuple(roots))
+    conf['source_summaries'][fullname] = tuple(summary)
+    return summary
+
+def output_file_hash(fullname, conf, file_hash=None):
+    """
+    Returns the hash of the contents of a split output file, ``fullname``, which
+    is only read if it has changed since its hash was saved.  If ``file_hash``
+    is given, the file has just been written with contents of that hash.
+    """
+    stat = os.stat(fullname)
+    cached = conf['output_hashes'].get(fullname)
+    if file_hash is None:
+        if cached and cached[0:2] == (stat.st_mtime, stat.st_size):
+            return cached[2]
+        digest = md5()
+        with open(fullname, 'rb') as file_handle:
+            block = file_handle.read(65536)
+            while block:
+                digest.update(block)
+                block = file_handle.read(65536)
+        file_hash = digest.hexdigest()
+    conf['output_hashes'][fullname] = (stat.st_mtime, stat.st_size, file_hash)
+    return file_hash
+
+def replace_file(out_file, content):
+    """
+    Replaces ``out_file`` with ``content``: either a list of strings, or the
+    name of a file to copy.  The new contents are written to a temporary file
+    alongside, which is then renamed, so ``out_file`` is never left half
+    written by a build that crashed (the ``.tmp`` suffix is ignored by Sphinx).
+    """
+    tmp_file = out_file + '.tmp'
+    try:
+        if isinstance(content, basestring):
+            shutil.copy2(content, tmp_file)
+        else:
+            with open(tmp_file, 'wb') as file_handle:
+                for line in content:
+                    file_handle.write(line)
+        if os.name == 'nt' and os.path.exists(out_file):
+            os.remove(out_file)  # os.rename does not replace files on Windows
+        os.rename(tmp_file, out_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
 
 def write_src_file(filename, content, app, srcfile=''):
     """
@@ -624,7 +826,9 @@ def write_src_file(filename, content, app, srcfile=''):
 
     The "smarts" come from the fact that if the ``content`` is exactly the same
     as is currently in the ``filename``, then the file is not written at all,
-    helping speed up compilation of the Sphinx document.
+    helping speed up compilation of the Sphinx document.  The hash of the
+    existing file is saved between builds (see ``output_file_hash``), and
+    changed files are replaced in a single step (see ``replace_file``).
 
     If ``content`` is just a string path to an existing file, then a copy of
     ``content`` is made.
@@ -632,35 +836,36 @@ def write_src_file(filename, content, app, srcfile=''):
     The ``app`` input is the Sphinx application object.  And ``srcfile`` is the
     full name of the RST source file which this sub section was split from.
     """
+    conf = app.env.config.ucomment
     out_file = os.path.join(app.env.srcdir, filename + REPLACE_SOURCE_SUFFIX)
-    hashdict = app.env.config.ucomment['split_file_hash']
+    hashdict = conf['split_file_hash']
     if isinstance(content, basestring):
         content_file = os.path.join(app.env.srcdir, content)
-        if os.path.isfile(content_file):
-            with open(content_file, 'r') as file_handle:
-                lines = file_handle.readlines()
-            hashdict[filename] = md5(''.join(lines)).hexdigest()
-            shutil.copy2(content_file, out_file)
-        else:
+        if not os.path.isfile(content_file):
             raise ExtensionError(('The ``content`` file must be an existing '
                                   'file.'))
-        app.env.config.ucomment['split_sources'][out_file] = content_file
+        # All source files were scanned in ``ucomment_builder_init_function``
+        file_hash = conf['source_summaries'][content_file][2]
+        if not os.path.isfile(out_file) or \
+                              output_file_hash(out_file, conf) != file_hash:
+            replace_file(out_file, content_file)
+            output_file_hash(out_file, conf, file_hash)
+        hashdict[filename] = file_hash
+        conf['split_sources'][out_file] = content_file
         return
 
-    file_hash = md5(''.join(content)).hexdigest()
-    app.env.config.ucomment['split_sources'][out_file] = srcfile
-    # If there is an existing file, get its hash also.
-    if os.path.isfile(out_file):
-        with open(out_file, 'r') as file_handle:
-            lines = file_handle.readlines()
-        hashdict[filename] = md5(''.join(lines)).hexdigest()
+    digest = md5()
+    for line in content:
+        digest.update(line)
+    file_hash = digest.hexdigest()
+    conf['split_sources'][out_file] = srcfile
 
     # Now test if we really need to write the ``content`` to ``filename``:
-    if (filename not in hashdict) or hashdict[filename] != file_hash or \
-                                                  not os.path.isfile(out_file):
-        hashdict[filename] = file_hash
-        with open(out_file, 'w') as file_handle:
-            file_handle.writelines(content)
+    if not os.path.isfile(out_file) or \
+                              output_file_hash(out_file, conf) != file_hash:
+        replace_file(out_file, content)
+        output_file_hash(out_file, conf, file_hash)
+    hashdict[filename] = file_hash
 
 def split_non_toc_file(name, remove, app, conf):
     """
@@ -694,8 +899,7 @@ def split_non_toc_file(name, remove, app, conf):
                        content = name + app.env.config.source_suffix, app=app)
         return [short]
 
-    with open(fullname, 'r') as source_file:
-        lines = source_file.readlines()
+    lines = read_source_lines(fullname)
 
     file_list = []
     for section, entry in enumerate(sorted(to_process.keys())):
@@ -852,8 +1056,8 @@ def split_rst_files(app, conf, remaining_files):
         fullname = os.path.join(app.env.srcdir,
                                 name + app.env.config.source_suffix)
 
-        with open(fullname, 'r') as source_file:
-            lines = source_file.readlines()
+        # A copy: the toctree lines are replaced below
+        lines = list(read_source_lines(fullname))
 
         # Which files are included by the toctree?   Replace the toctree with
         # a tuple, containing the list of included files.
@@ -1004,19 +1208,53 @@ def copy_static_content(app, exception):
     ensuredir(src)
     ensuredir(conf['media_root']) # destination
 
-    copy_command = ['cp', '-ru', src+os.sep+'.', conf['media_root']]
+    # Only new and changed images are transferred; images no longer in the
+    # document are removed.  See ``mediasync.py`` in the Django application.
+    mediasync = __import__(conf['app_dirname'] + '.mediasync', None, None,
+                           ['mediasync'])
     try:
-        subprocess.check_call(copy_command, stdout=subprocess.PIPE, cwd='.')
-    except subprocess.CalledProcessError as e:
+        counts = mediasync.sync_directory(src, conf['media_root'])
+    except (OSError, IOError) as e:
         app.builder.warn('Unable to copy over the image data to the '
-                        'static web-directory: return code = %s' % \
-                        str(e.returncode))
+                        'static web-directory: %s' % str(e))
         return
+    app.info(('ucomment: %(copied)d images copied, %(removed)d removed and '
+              '%(unchanged)d unchanged.') % counts)
 
     # TODO(KGD): consider converting images from PNG to JPG; rewrite URL's also
     # There is a builder variable that contains all images (that variable is
     # used to copy the images to _images/ dir.
 
+def get_line_offsets(split_files):
+    """
+    Returns a dictionary with the line offset of every (split) file in the RST
+    source file it was taken from, given the ``split_files`` setting.  Used by
+    the translator to give comment references their line in the source file.
+    """
+    line_offset = {}
+    for srcname, fileoffsets in split_files.iteritems():
+        if len(fileoffsets) > 1:
+            new_files = dict((v, k) for k, v in fileoffsets.iteritems())
+            line_offset.update(new_files)
+        elif len(fileoffsets) == 1:
+            line_offset[srcname] = fileoffsets.keys()[0]
+        elif len(fileoffsets) == 0:
+            line_offset[srcname] = 0
+    return line_offset
+
+def lap_timing(conf, next_phase=None):
+    """
+    Ends the build phase that is running, recording its duration in seconds in
+    ``conf['timings']``, and starts timing ``next_phase`` (if given).  The
+    Django application reports these timings after publishing.
+    """
+    now = time.time()
+    if conf.get('timing_phase'):
+        conf['timings'].append((conf['timing_phase'],
+                                now - conf['timing_start']))
+    conf['timing_phase'] = next_phase
+    conf['timing_start'] = now
+
 def ucomment_builder_init_function(app):
     """
     Prepares the compile area:
@@ -1026,6 +1264,9 @@ def ucomment_builder_init_function(app):
 
     # This conf dict is the one that is loaded from the last saved session
     conf = app.env.config.ucomment
+    conf['timings'] = []
+    conf['timing_phase'] = None
+    lap_timing(conf, 'ucomment: builder-inited')
     # This conf dict is the one specified in the user's ``conf.py`` file; we
     # will give settings in this dictionary preference.
     user_conf = app.config.ucomment
@@ -1077,8 +1318,13 @@ def ucomment_builder_init_function(app):
     # after we have compiled the HTML to pickle files.
     conf['comment_refs'] = []
 
-    # List of comment roots that have been used already
-    conf['used_roots'] = []
+    # Set of comment roots that have been used already.  The Django application
+    # adds the roots of references that have comments, before building.
+    conf['used_roots'] = set()
+
+    # The comment roots of the references in the Django database, and the page
+    # (docname) of each: a new root is never one that belongs to another page.
+    conf['reference_roots'] = {}
 
     # Internal setting used by Django, but must be set, in case Sphinx is called
     # in stand-alone mode.
@@ -1090,9 +1336,24 @@ def ucomment_builder_init_function(app):
     if 'split_file_hash' not in conf:
         conf['split_file_hash'] = {}
 
+    # Internal settings used by this extension: what was found in each source
+    # file, and the hash of each split file, saved between builds so that
+    # unchanged files are not read again.
+    if 'source_summaries' not in conf:
+        conf['source_summaries'] = {}
+    if 'output_hashes' not in conf:
+        conf['output_hashes'] = {}
+    source_lines.clear()
+    source_line_cache.clear()
+
     # Reset this back to empty every time:
     conf['toc_docs'] = set()
 
+    # The comment roots found in each document, as it is read.  Stored in the
+    # environment, so that it is pickled along with it.
+    if not hasattr(app.env, 'ucomment_roots'):
+        app.env.ucomment_roots = {}
+
     # Ensure these settings exist, otherwise put default values
     # ----------------------------------------------------------
     # This allows us to compile the RST document from the command line using
@@ -1109,9 +1370,8 @@ def ucomment_builder_init_function(app):
         conf['media_root'] = os.path.join(app.builder.outdir, '_images')
 
     conf['skip_nodes_in'] = set(conf['skip_nodes_in'])
+    conf['skip_nodes_in'].add(u'<partial node>')
 
-    # Regular expression for ucomment lines: adds them to the list of used nodes
-    ucomment_lines = re.compile(r'^\s*\.\. ucomment::\s*(.*?):')
     # Regular expression that picks up the main section dividers
     try:
         div_re = re.compile(r'^' + conf['section_div'] + \
@@ -1120,6 +1380,11 @@ def ucomment_builder_init_function(app):
         # From: http://stackoverflow.com/questions/1845078
         div_re = re.compile(r'(?!x)x')
 
+    # The saved summaries depend on the section dividers
+    if conf.get('source_summaries_div') != div_re.pattern:
+        conf['source_summaries'] = {}
+        conf['source_summaries_div'] = div_re.pattern
+
     # Reload the list of files.  You must use ``app.config`` (do not use
     # ``app.env.config`` - that was loaded from the pickle file).
     app.env.find_files(app.config)
@@ -1128,7 +1393,9 @@ def ucomment_builder_init_function(app):
 
     # Preliminary scan of the documents to find those that contain .. toctree::
     # directives, or the file that is the main TOC.  Also, initializes the
-    # 'split_sources' and 'split_files' settings to useful values
+    # 'split_sources' and 'split_files' settings to useful values.  This is the
+    # only scan of each source file: see ``scan_source_file``.
+    summaries = []
     for name in list(app.env.found_docs):
 
         # Use app.config.source_suffix: i.e. use the original suffix for
@@ -1137,34 +1404,23 @@ def ucomment_builder_init_function(app):
                                            name + app.config.source_suffix)
 
         conf['split_sources'][fullname] = fullname
+        summary = scan_source_file(fullname, conf, div_re)
+        summaries.append(summary)
 
-        with open(fullname, 'r') as source_file:
-            lines = source_file.readlines()
+        if summary.has_toctree:
+            toc_docs.add(name)
+            remaining_files.remove(name)
 
         # This dict has keys="line offset in the RST file for each section",
         # while the corresponding value="file name to which that subsection
         # will be written".
-        to_process = {}
-        has_toctree = False
-        for idx, line in enumerate(lines):
-            if div_re.search(line.rstrip()):
-                to_process[idx-1] = ''
-            if TOCTREE_RE.match(line):
-                # Minor defect: we can't handle cases when the text
-                # ``.. toctree:: `` is used in a document.  So we will ignore
-                # this directive as long as it is away from the left edge of the
-                # page: it isn't really a toctree.  Occurs when one is document-
-                # ing the toctree directive, e.g. showing it in source code.
-                if len(TOCTREE_RE.match(line).group(1).expandtabs()) > 0:
-                    continue
+        conf['split_files'][name] = dict.fromkeys(summary.dividers, '')
 
-                has_toctree = True
-
-        if has_toctree:
-            toc_docs.add(name)
-            remaining_files.remove(name)
-
-        conf['split_files'][name] = to_process
+    # Forget the summaries of files that no longer exist
+    scanned = set(conf['split_sources'])
+    for fullname in conf['source_summaries'].keys():
+        if fullname not in scanned:
+            del conf['source_summaries'][fullname]
 
     # Store the files which contain toctree directive. These files are not
     # commentable.
@@ -1220,6 +1476,7 @@ def ucomment_builder_init_function(app):
                                 entry + app.env.config.source_suffix)
                 if os.path.exists(fullname):
                     os.remove(fullname)
+                conf['output_hashes'].pop(fullname, None)
 
             # Clean the list up again.
             app.env.find_files(app.env.config)
@@ -1245,31 +1502,53 @@ def ucomment_builder_init_function(app):
         # Sphinx will pick up their new file times and recompile them.
         app.config.ucomment = app.env.config.ucomment
 
-    # Scan for any ucomment directives in the source files
-    all_files = app.env.found_docs
-    for fname in list(all_files):
-        name = os.path.join(app.env.srcdir, fname+app.env.config.source_suffix)
+    # The ucomment directives in the source files, found while scanning them
+    for summary in summaries:
+        conf['used_roots'].update(summary.roots)
+    source_lines.clear()
+
+    # The files are split by now: used by every translator
+    conf['line_offsets'] = get_line_offsets(conf['split_files'])
 
-        with open(name, 'r') as f_handle:
-            lines = f_handle.readlines()
+    lap_timing(conf, 'sphinx: read')
 
-        for line in lines:
-            has_ucomment =  ucomment_lines.match(line)
-            if has_ucomment:
-                conf['used_roots'].append(has_ucomment.groups()[0])
+def ucomment_env_purge_doc(app, env, docname):
+    """ Forgets the comment roots of a document that is about to be re-read."""
+    env.ucomment_roots.pop(docname, None)
+
+def ucomment_env_merge_info(app, env, docnames, other):
+    """
+    Merges the comment roots found by a parallel reader process (in the
+    ``other`` environment) for the documents ``docnames`` into ``env``.
+    """
+    for docname in docnames:
+        if docname in other.ucomment_roots:
+            env.ucomment_roots[docname] = other.ucomment_roots[docname]
+
+def ucomment_env_updated_function(app, env):
+    """
+    All documents have been read: add the comment roots found in them to the
+    set of used roots, before any new roots are created while writing.
+    """
+    for roots in env.ucomment_roots.itervalues():
+        app.env.config.ucomment['used_roots'].update(roots)
+    lap_timing(app.env.config.ucomment, 'sphinx: write')
 
 def ucomment_build_finished_function(app, exception):
     """ Clean up after finished building. Must be done in order. """
     conf = app.env.config.ucomment
     if conf['skip-cleanup']:
+        lap_timing(conf)
         return
 
+    lap_timing(conf, 'ucomment: static copy')
     try:
         copy_static_content(app, exception)
     except Exception as e:
         print('An exception (%s) occurred while using the ucomment '
               'extension' % e.__class__.__name__)
         raise(e)
+    lap_timing(conf)
 
     # Remove any .ucomment files  that should have been deleted.
     set(app.env.all_docs) - app.env.found_docs
@@ -1296,7 +1575,18 @@ def setup(app):
     # in, we split the RST files apart according to their main sections.
     # Once the builder is finished, before Sphinx terminates, we undo the split.
     app.connect('builder-inited', ucomment_builder_init_function)
+    app.connect('env-purge-doc', ucomment_env_purge_doc)
+    app.connect('env-updated', ucomment_env_updated_function)
     app.connect('build-finished', ucomment_build_finished_function)
 
+    # Sphinx 1.3 and newer can read the documents in parallel.  Reading keeps
+    # its state per-document (merged back here), but writing does not: the
+    # translator collects the comment references in the shared settings.
+    try:
+        app.connect('env-merge-info', ucomment_env_merge_info)
+    except ExtensionError:
+        pass
+    return {'parallel_read_safe': True, 'parallel_write_safe': False}
+
 
 
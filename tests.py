@@ -1,11 +1,14 @@
 """ Tests for the document application. """
 
-import os, shutil, tempfile, collections, re
+import os, shutil, tempfile, collections, re, time, datetime
+from StringIO import StringIO
 from django.test import TestCase
+from django.contrib.auth.models import User
 from sphinx.util import ensuredir
 from models import CommentReference
 from conf import settings as conf
 import views as views
+import mediasync
 
 if conf.repo_DVCS_type == 'hg':
     import hgwrapper as dvcs
@@ -244,6 +247,124 @@ class CompileTests(TestCase):
                     self.assertEqual(node, 'A1')
 
 
+    def test_incremental_publish(self):
+        """ Republishing an unchanged document does not rewrite any pages.
+        """
+        self.assertEqual(views.call_sphinx_to_publish(), '')
+        pages = views.models.Page.objects.exclude(link_name='_orphans_')
+        before = dict(pages.values_list('link_name', 'content_hash'))
+        self.assertTrue(all(before.values()))
+
+        # Clear the stored bodies: only a forced publish should restore them.
+        # Unchanged pages are not even loaded: overwrite their pickle files,
+        # keeping the size and modification time.
+        pages.update(body='')
+        pickle_dir = os.path.join(conf.local_repo_physical_dir, '_build',
+                                  'pickle')
+        for root, dirs, files in os.walk(pickle_dir):
+            for name in files:
+                if name.endswith('.fpickle'):
+                    filename = os.path.join(root, name)
+                    stat = os.stat(filename)
+                    with open(filename, 'wb') as f_handle:
+                        f_handle.write('\0' * stat.st_size)
+                    os.utime(filename, (stat.st_atime, stat.st_mtime))
+        self.assertEqual(views.call_sphinx_to_publish(), '')
+        self.assertEqual(dict(pages.values_list('link_name', 'content_hash')),
+                         before)
+        self.assertFalse(any(pages.values_list('body', flat=True)))
+
+        self.assertEqual(views.call_sphinx_to_publish(force=True), '')
+        self.assertTrue(all(pages.values_list('body', flat=True)))
+
+    def test_benchmark_translator_setup(self):
+        """ A translator is created for every document that is written, so
+        its setup, done once per build, must be cheap.
+        """
+        self.assertEqual(views.call_sphinx_to_publish(), '')
+        repo_dir = conf.local_repo_physical_dir
+        build_dir = os.path.join(repo_dir, '_build')
+        app = views.Sphinx(repo_dir, repo_dir, os.path.join(build_dir, 'pickle'),
+                           os.path.join(build_dir, 'doctrees'), 'pickle',
+                           status=StringIO(), warning=StringIO())
+        docname = app.env.config.master_doc
+        doctree = app.env.get_doctree(docname)
+        app.builder.prepare_writing(set([docname]))
+        doctree.settings = app.builder.docsettings
+
+        start_time = time.time()
+        for idx in xrange(1000):
+            translator = app.builder.translator_class(app.builder, doctree)
+        # A generous bound: setting up a translator is only a few attributes
+        self.assertTrue(time.time() - start_time < 10.0)
+        self.assertTrue(translator.line_offset is \
+                        app.env.config.ucomment['line_offsets'])
+
+
+class Test_Comment_Roots(TestCase):
+    """
+    New comment roots never take over the comment reference of a node on
+    another page, even when that page is not rewritten by the build.
+    """
+    setUp = CompileTests.__dict__['setUp']
+    tearDown = CompileTests.__dict__['tearDown']
+
+    def commit_to_remote(self, filename, lines):
+        remote_repo = self.tempdir + 'remote_repo'
+        with open(os.path.join(remote_repo, filename), 'w') as f_handle:
+            f_handle.writelines(lines)
+        dvcs.commit(override_dir=remote_repo, message='Changed ' + filename)
+
+    def test_new_roots_never_reuse_references(self):
+        self.assertEqual(views.call_sphinx_to_publish(), '')
+        # The references now belong to a page that is not in the document
+        refs = CommentReference.objects.all()
+        refs.update(page_link_name='another-page')
+        before = set(refs.values_list('comment_root', 'file_name',
+                                      'line_number'))
+        self.assertEqual(views.call_sphinx_to_publish(force=True), '')
+        self.assertEqual(set(refs.filter(page_link_name='another-page')\
+                    .values_list('comment_root', 'file_name', 'line_number')),
+                         before)
+        new_roots = set(refs.exclude(page_link_name='another-page')\
+                                    .values_list('comment_root', flat=True))
+        self.assertTrue(new_roots)
+        self.assertFalse(new_roots & set(root for root, _, _ in before))
+
+    def test_identical_nodes_in_split_sections(self):
+        remote_repo = self.tempdir + 'remote_repo'
+        with open(os.path.join(remote_repo, 'conf.py')) as f_handle:
+            lines = f_handle.readlines()
+        lines = [line.replace("ucomment['section_div'] = ''",
+                              "ucomment['section_div'] = '='") for line in lines]
+        self.commit_to_remote('conf.py', lines)
+        chapter = ['Section one\n', '===========\n', '\n',
+                   'The same paragraph, in both sections.\n', '\n',
+                   'Section two\n', '===========\n', '\n',
+                   'The same paragraph, in both sections.\n']
+        self.commit_to_remote('chapter03.rst', chapter)
+        self.assertEqual(views.call_sphinx_to_publish(), '')
+
+        filename = os.path.join(conf.local_repo_physical_dir, 'chapter03.rst')
+        refs = CommentReference.objects.filter(file_name=filename,
+                                               node_type='paragraph')
+        pages = dict(refs.values_list('line_number', 'page_link_name'))
+        self.assertEqual(len(set(pages.values())), 2)
+        roots = refs.values_list('comment_root', flat=True)
+        self.assertEqual(len(set(roots)), 2)
+        first = refs.get(line_number=min(pages))
+        first = (first.comment_root, first.page_link_name, first.line_number)
+
+        # Only the second section changes, and is rebuilt
+        self.commit_to_remote('chapter03.rst', chapter + ['\n',
+                              'Another paragraph.\n'])
+        self.assertEqual(views.call_sphinx_to_publish(), '')
+        ref = CommentReference.objects.get(comment_root=first[0])
+        self.assertEqual((ref.comment_root, ref.page_link_name,
+                          ref.line_number), first)
+        self.assertEqual(refs.filter(line_number=max(pages)).count(), 1)
+
+
 class Test_DVCS(TestCase):
     def setUp(self):
         """ Use a known testing file; write it to a temporary location for
@@ -349,6 +470,540 @@ class Test_DVCS(TestCase):
             local_lines = f_handle.readlines()
         self.assertEqual(local_lines, final_result)
 
+        # Only ``index.rst`` has changed since the first commit
+        self.assertEqual(dvcs.changed_files(rev0, 'tip'), [('M', 'index.rst')])
+        self.assertEqual(dvcs.changed_files('tip', 'tip'), [])
+
+class Test_Search_Formatting(TestCase):
+    """
+    Search results: snippets are built around the search hits, overlapping
+    regions merged, and the search terms highlighted.
+    """
+    # Behaves like a ``Page`` object for the purpose of these tests.
+    SearchPage = collections.namedtuple('Page',
+                                        'link_name html_title search_text')
+
+    def test_merge_spans(self):
+        self.assertEqual(views.merge_spans([]), [])
+        self.assertEqual(views.merge_spans([(10, 20), (0, 5), (15, 30)]),
+                         [(0, 5), (10, 30)])
+        # Spans that touch, or are contained in another, are merged
+        self.assertEqual(views.merge_spans([(0, 10), (10, 12), (2, 4)]),
+                         [(0, 12)])
+
+    def test_overlapping_hits(self):
+        search_re = views.compile_search_regex(['quick', 'fox'], False)
+        text = 'The quick brown fox jumps over the lazy dog.'
+        n_hits, display = views.search_snippet(text, search_re, 10, False)
+        self.assertEqual(n_hits, 2)
+        # Both hits overlap: a single region is displayed
+        self.assertEqual(display.count('...'), 2)
+        self.assertEqual(display.count('<span id="ucomment-search-term">'), 2)
+
+        # Only whole words are matched; and case is respected if required
+        search_re = views.compile_search_regex(['Fox'], True)
+        n_hits, _ = views.search_snippet('fox Foxes Fox', search_re, 5, True)
+        self.assertEqual(n_hits, 1)
+
+    def test_highlight_not_inside_entities(self):
+        search_re = views.compile_search_regex(['amp', 'lt'], False)
+        text = 'Salt & pepper <b> lt amp'
+        n_hits, display = views.search_snippet(text, search_re, 100, False)
+        self.assertEqual(n_hits, 2)
+        self.assertTrue('&amp; pepper &lt;b&gt;' in display)
+        self.assertTrue('<span id="ucomment-search-term">lt</span> '
+                        '<span id="ucomment-search-term">amp</span>' in display)
+
+    def test_benchmark_500_pages(self):
+        words = ['regression', 'model']
+        paragraph = ('A linear regression model is fitted to the data; the '
+                     'model residuals are then checked for outliers. ') * 40
+        pages = {}
+        for idx in xrange(500):
+            page = self.SearchPage('page-%d' % idx, 'Page %d' % idx,
+                                   paragraph + ' page %d' % idx)
+            pages[page] = words
+
+        start_time = time.time()
+        web_output = views.format_search_pages_for_web(pages, 90, False)
+        # A generous bound: this takes well under a second
+        self.assertTrue(time.time() - start_time < 10.0)
+        self.assertTrue('Found 500 pages matching' in web_output)
+        self.assertEqual(web_output.count('<li>'), 500)
+
+    def test_paginated_results(self):
+        pages = {}
+        for idx in xrange(1, 31):
+            page = self.SearchPage('page-%d' % idx, 'Page %d' % idx,
+                                   'model ' * idx)
+            pages[page] = ['model']
+
+        search_re = views.compile_search_regex(['model'], False)
+        n_pages, top = views.rank_search_pages(pages.keys(), search_re,
+                                               offset=10, limit=10)
+        self.assertEqual(n_pages, 30)
+        self.assertEqual([n_hits for n_hits, _ in top], range(20, 10, -1))
+
+        web_output = views.format_search_pages_for_web(pages, 90, False,
+                                        offset=10, limit=10, base_url='/s/')
+        self.assertTrue('Found 30 pages matching' in web_output)
+        self.assertTrue('Showing results 11 to 20.' in web_output)
+        self.assertEqual(web_output.count('<li>'), 10)
+        self.assertTrue('href="/s/offset=0/limit=10"' in web_output)
+        self.assertTrue('href="/s/offset=20/limit=10"' in web_output)
+
+        # The links never contain raw markup from the search terms
+        web_output = views.format_search_pages_for_web(pages, 90, False,
+                        offset=10, limit=10, base_url='/s/"><script>x/')
+        self.assertFalse('<script>' in web_output)
+        self.assertTrue('href="/s/&quot;&gt;&lt;script&gt;x/offset=20/'
+                        'limit=10"' in web_output)
+
+    def test_search_api_paging(self):
+        url = views.django_reverse('ucomment-search-api')
+        for query, offset, limit in (('', 0, conf.search_api_results),
+                                     ('&offset=5&limit=3', 5, 3),
+                                     ('&offset=x&limit=-2', 0,
+                                      conf.search_api_results),
+                                     ('&limit=100000', 0,
+                                      conf.search_api_max_results)):
+            response = self.client.get(url + '?q=nothing-matches' + query)
+            result = views.simplejson.loads(response.content)
+            self.assertEqual((result['offset'], result['limit']),
+                             (offset, limit))
+
+    def test_sanitize_search_text(self):
+        text = '\n'.join(['Title',
+                          '=====',
+                          '',
+                          '.. ucomment:: ABCDEF: 1i,',
+                          '.. _my-cross-reference:',
+                          'Some :math:`a+b` and :math:`c` text.',
+                          '.. rubric:: Summary',
+                          '.. figure:: the_figure.png',
+                          '   :scale: 50',
+                          '   :alt: Some figure',
+                          '',
+                          '   The caption.',
+                          '+-----+-----+',
+                          '| one | two |',
+                          '+=====+=====+',
+                          '=====  =====',
+                          'three  four',
+                          '=====  ====='])
+        out = views.sanitize_search_text(text).split('\n')
+        self.assertEqual(out, ['Title', '', 'Some a+b and c text.', 'Summary',
+                               '', '   The caption.', '  one   two  ',
+                               'three  four'])
+
+    def test_benchmark_sanitize_search_text(self):
+        testing_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   'testing')
+        corpus = []
+        for filename in os.listdir(testing_dir):
+            if filename.endswith('.rst'):
+                with open(os.path.join(testing_dir, filename)) as f_handle:
+                    corpus.append(f_handle.read())
+        corpus = '\n'.join(corpus)
+        # Repeat the RST test files to get a multi-megabyte corpus
+        corpus = corpus * (4 * 1024 * 1024 / len(corpus) + 1)
+
+        start_time = time.time()
+        out = views.sanitize_search_text(corpus)
+        # A generous bound for a few megabytes of RST source
+        self.assertTrue(time.time() - start_time < 30.0)
+        self.assertFalse('.. ucomment::' in out)
+        self.assertFalse(':math:`' in out)
+
+
+class Test_Page_Search_Text(TestCase):
+    """
+    The search text is stored apart from the pages, optionally compressed, and
+    the same pages are found either way.
+    """
+    def setUp(self):
+        self.compress_search_text = conf.compress_search_text
+
+    def tearDown(self):
+        conf.compress_search_text = self.compress_search_text
+
+    def create_pages(self):
+        texts = ['A linear regression model.', 'A model of the process.',
+                 u'Regression with \u00e9l\u00e8ves.']
+        for idx, text in enumerate(texts):
+            page = views.models.Page.objects.create(link_name='page-%d' % idx,
+                                                    html_title='Page %d' % idx,
+                                                    body='', sidebar='')
+            search = views.models.PageSearchText(page=page)
+            search.set_text(text)
+            search.save()
+
+    def found_pages(self, search, search_type, with_case=False):
+        pages = views.find_search_pages(search, search_type, with_case)
+        return sorted([page.link_name for page in pages])
+
+    def check_searching(self):
+        self.create_pages()
+        self.assertEqual(self.found_pages('regression model', 'AND'),
+                         ['page-0'])
+        self.assertEqual(self.found_pages('regression model', 'OR'),
+                         ['page-0', 'page-1', 'page-2'])
+        self.assertEqual(self.found_pages('PROCESS', 'AND'), ['page-1'])
+        self.assertEqual(self.found_pages('the', 'OR'), [])  # a stop word
+        self.assertEqual(self.found_pages('Regression', 'OR', True),
+                         ['page-2'])
+        self.assertEqual(self.found_pages('PROCESS', 'AND', True), [])
+
+    def test_uncompressed(self):
+        conf.compress_search_text = False
+        self.check_searching()
+
+    def test_compressed(self):
+        conf.compress_search_text = True
+        self.check_searching()
+        search = views.models.PageSearchText.objects.get(
+                                                    page__link_name='page-2')
+        self.assertTrue(search.is_compressed)
+        self.assertEqual(search.get_text(), u'Regression with \u00e9l\u00e8ves.')
+
+    def test_rebuild_search_text(self):
+        conf.compress_search_text = False
+        self.create_pages()
+        views.models.Page.objects.create(link_name='no-search-text',
+                                         body='', sidebar='')
+        conf.compress_search_text = True
+        report = views.rebuild_search_text(dry_run=True)
+        self.assertEqual(report, {'created': 0, 'converted': 3, 'missing': 1,
+                                  'old_column': False})
+        self.assertEqual(views.models.PageSearchText.objects.filter(
+                                            is_compressed=True).count(), 0)
+        views.rebuild_search_text()
+        self.assertEqual(views.models.PageSearchText.objects.filter(
+                                            is_compressed=True).count(), 3)
+        self.assertEqual(self.found_pages('PROCESS', 'AND'), ['page-1'])
+
+
+class Test_Publish_Helpers(TestCase):
+    """
+    Helpers used when committing the published document to the database.
+    """
+    def test_chunked(self):
+        self.assertEqual(list(views.chunked(range(5), 2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(views.chunked([], 2)), [])
+
+    def test_bulk_insert(self):
+        links = [views.models.Link(link='link-%d' % idx, title='') for idx in \
+                                                                    xrange(10)]
+        views.bulk_insert(views.models.Link, links)
+        self.assertEqual(views.models.Link.objects.filter(
+                                        link__startswith='link-').count(), 10)
+
+    def test_page_content_hash(self):
+        page_info = {'body': u'<p>Caf\u00e9</p>', 'title': u'Title',
+                     'toc': u'', 'parents': [], 'next': None, 'prev': None}
+        first = views.page_content_hash(page_info, 'Source', 'project')
+        self.assertEqual(first, views.page_content_hash(dict(page_info),
+                                                        'Source', 'project'))
+        self.assertNotEqual(first, views.page_content_hash(page_info,
+                                                'Source.', 'project'))
+        page_info['next'] = {'link': u'../next/', 'title': u'Next'}
+        self.assertNotEqual(first, views.page_content_hash(page_info,
+                                                'Source', 'project'))
+
+    def test_phase_timer(self):
+        timer = views.PhaseTimer()
+        timer.lap('first')
+        timer.lap('second')
+        report = timer.report()
+        self.assertEqual([phase for phase, _ in timer.phases],
+                         ['first', 'second'])
+        self.assertTrue(report.startswith('first = '))
+        self.assertTrue('; total = ' in report)
+
+        timer.build_phases = [('sphinx: read', 1.5)]
+        timer.counts['pages'] = 12
+        lines = timer.as_text().split('\n')
+        self.assertTrue(lines[0].startswith('first '))
+        self.assertTrue(lines[2].startswith('total '))
+        self.assertTrue('Within the Sphinx build:' in lines)
+        self.assertTrue(lines[-1].startswith('pages '))
+        self.assertTrue(lines[-1].endswith(' 12'))
+
+
+class Test_Publish_Jobs(TestCase):
+    """
+    Publishing runs as a background job, which the author can follow; only one
+    job may run at a time.
+    """
+    def setUp(self):
+        User.objects.create_user('author', 'author@example.com', 'secret')
+        self.client.login(username='author', password='secret')
+
+    def test_job_status(self):
+        job = views.models.PublishJob.objects.create(status='running',
+                                                     phase='saving pages')
+        views.set_publish_progress(job.pk, pages_processed=5, pages_total=9)
+        try:
+            response = self.client.get(views.django_reverse(
+                                'ucomment-publish-status', args=[job.pk]))
+        finally:
+            views.publish_progress.pop(job.pk, None)
+        status = views.simplejson.loads(response.content)
+        self.assertEqual(status['status'], 'running')
+        self.assertEqual(status['phase'], 'saving pages')
+        self.assertEqual((status['pages_processed'], status['pages_total']),
+                         (5, 9))
+
+    def test_one_job_at_a_time(self):
+        job = views.models.PublishJob.objects.create(status='running')
+        response = self.client.get(views.django_reverse(
+                                        'ucomment-publish-update-document'))
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(views.models.PublishJob.objects.count(), 1)
+
+        # A job that has run for too long no longer blocks a new publish
+        views.models.PublishJob.objects.filter(pk=job.pk).update(
+            started_on=datetime.datetime.now() - datetime.timedelta(
+                                    seconds=conf.publish_job_timeout + 1))
+        self.assertEqual(views.active_publish_job(), None)
+        self.assertEqual(views.models.PublishJob.objects.get(pk=job.pk).status,
+                         'failed')
+
+    def test_publish_history(self):
+        PublishJob = views.models.PublishJob
+        self.assertEqual(views.last_published_revision(), None)
+        self.assertEqual(views.estimate_publish_time(), None)
+        now = datetime.datetime.now()
+        for rev, secs in (('aaa', 30), ('bbb', 10), ('ccc', 20)):
+            job = PublishJob.objects.create(status='succeeded',
+                                            revision_changeset=rev)
+            PublishJob.objects.filter(pk=job.pk).update(started_on=now,
+                        finished_on=now + datetime.timedelta(seconds=secs))
+            now += datetime.timedelta(minutes=1)
+        PublishJob.objects.create(status='failed', revision_changeset='ddd')
+        self.assertEqual(views.last_published_revision(), 'ccc')
+        self.assertEqual(views.estimate_publish_time(), 20)
+
+        # Publishes that had nothing to do are not part of the estimate
+        for idx in xrange(3):
+            job = PublishJob.objects.create(status='succeeded',
+                                            revision_changeset='ccc')
+            PublishJob.objects.filter(pk=job.pk).update(started_on=now,
+                                    finished_on=now, phase='unchanged')
+        self.assertEqual(views.estimate_publish_time(), 20)
+        self.assertEqual(views.estimate_publish_time(force=True), None)
+
+    def test_publish_unchanged(self):
+        PublishJob = views.models.PublishJob
+        fingerprint = views.publish_fingerprint()
+        self.assertEqual(fingerprint, views.publish_fingerprint())
+        self.assertFalse(views.publish_unchanged('aaa', fingerprint))
+        PublishJob.objects.create(status='succeeded', revision_changeset='aaa',
+                                  settings_hash=fingerprint,
+                                  finished_on=datetime.datetime.now())
+        self.assertTrue(views.publish_unchanged('aaa', fingerprint))
+        self.assertFalse(views.publish_unchanged('bbb', fingerprint))
+        self.assertFalse(views.publish_unchanged('aaa', 'other settings'))
+
+        # A later publish of the same revision that did not reach the database
+        # records no fingerprint: the next publish is not skipped
+        PublishJob.objects.create(status='succeeded', revision_changeset='aaa',
+                finished_on=datetime.datetime.now() + datetime.timedelta(1))
+        self.assertFalse(views.publish_unchanged('aaa', fingerprint))
+
+
+class Test_Comment_References(TestCase):
+    """
+    The comment references found while publishing are reconciled with those
+    in the database: new, moved, removed and orphaned references.
+    """
+    SphinxRef = collections.namedtuple('CommentReference',
+                                       'source node line root link_name')
+
+    def setUp(self):
+        models = views.models
+        self.page = models.Page.objects.create(link_name='chapter',
+                                               body='', sidebar='')
+        poster = models.CommentPoster.objects.create(long_name='Poster',
+                                                     name='Poster')
+        for root, line in (('AAAAAA', 3), ('BBBBBB', 5), ('CCCCCC', 7)):
+            ref = models.CommentReference.objects.create(
+                        revision_changeset='1', file_name='chapter.rst',
+                        page_link_name='chapter', node_type='paragraph',
+                        line_number=line, comment_root=root)
+        models.Comment.objects.create(page=self.page, poster=poster,
+                                      reference=ref, node='x1', parent=root,
+                                      IP_address='127.0.0.1')
+
+    def publish(self, roots_lines):
+        refs = [self.SphinxRef('chapter.rst', 'paragraph', line, root,
+                               'chapter.rst') for root, line in roots_lines]
+        return views.commit_comment_references(refs,
+                                               {'chapter.rst': 'chapter'}, '2',
+                                               {'chapter': self.page},
+                                               use_freshenv=True)
+
+    def test_reconcile(self):
+        models = views.models
+        counts = self.publish([('AAAAAA', 4), ('DDDDDD', 9)])
+        self.assertEqual(counts, {'new': 1, 'updated': 1, 'moved': 1,
+                                  'removed': 1, 'orphaned': 1})
+        roots = set(models.CommentReference.objects.values_list(
+                                                'comment_root', flat=True))
+        self.assertEqual(roots, set(['AAAAAA', 'CCCCCC', 'DDDDDD', '_ORFN_']))
+        self.assertEqual(models.CommentReference.objects.get(
+                                comment_root='AAAAAA').line_number, 4)
+        comment = models.Comment.objects.get()
+        self.assertEqual(comment.reference.comment_root, '_ORFN_')
+        self.assertEqual(comment.page.link_name, '_orphans_')
+
+        # The author brings the node back: the comment is re-parented
+        self.publish([('AAAAAA', 4), ('CCCCCC', 7), ('DDDDDD', 9)])
+        comment = models.Comment.objects.get()
+        self.assertEqual(comment.reference.comment_root, 'CCCCCC')
+        self.assertEqual(comment.page.link_name, 'chapter')
+
+    def test_collect_unused_references(self):
+        models = views.models
+        models.Page.objects.filter(pk=self.page.pk).update(
+                                    body='<p class="ucomment" id="AAAAAA">')
+        old = datetime.datetime.now() - datetime.timedelta(days=400)
+        models.CommentReference.objects.update(date_added=old)
+        models.CommentReference.objects.create(revision_changeset='2',
+                        file_name='chapter.rst', page_link_name='chapter',
+                        node_type='paragraph', line_number=9,
+                        comment_root='EEEEEE')
+
+        # Only BBBBBB goes: AAAAAA is on the page, CCCCCC has a comment and
+        # EEEEEE was published too recently.
+        report = views.collect_unused_references(retention_days=365,
+                                                 batch_size=1, dry_run=True)
+        self.assertEqual((report['before'], report['removed'],
+                          report['after']), (4, 1, 4))
+        report = views.collect_unused_references(retention_days=365,
+                                                 batch_size=1)
+        self.assertEqual((report['removed'], report['after']), (1, 3))
+        roots = set(models.CommentReference.objects.values_list(
+                                                'comment_root', flat=True))
+        self.assertEqual(roots, set(['AAAAAA', 'CCCCCC', 'EEEEEE']))
+
+
+class Test_Media_Sync(TestCase):
+    """
+    Images are transferred to the media directory only when they are new or
+    have changed; images removed from the source are removed from the copy.
+    """
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tempdir, 'src')
+        self.dst = os.path.join(self.tempdir, 'dst')
+        ensuredir(os.path.join(self.src, 'math'))
+        for name, contents in (('a.png', 'A'), ('b.png', 'B'),
+                               (os.path.join('math', 'c.png'), 'C')):
+            with open(os.path.join(self.src, name), 'wb') as f_handle:
+                f_handle.write(contents)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_sync_directory(self):
+        counts = mediasync.sync_directory(self.src, self.dst)
+        self.assertEqual(counts, {'copied': 3, 'removed': 0, 'unchanged': 0})
+        with open(os.path.join(self.dst, 'math', 'c.png'), 'rb') as f_handle:
+            self.assertEqual(f_handle.read(), 'C')
+
+        # Other files in the media directory are left alone
+        with open(os.path.join(self.dst, 'ucomment.css'), 'w') as f_handle:
+            f_handle.write('body {}')
+        counts = mediasync.sync_directory(self.src, self.dst)
+        self.assertEqual(counts, {'copied': 0, 'removed': 0, 'unchanged': 3})
+
+        os.remove(os.path.join(self.src, 'a.png'))
+        os.remove(os.path.join(self.src, 'b.png'))
+        with open(os.path.join(self.src, 'b.png'), 'wb') as f_handle:
+            f_handle.write('BB')
+        counts = mediasync.sync_directory(self.src, self.dst)
+        self.assertEqual(counts, {'copied': 1, 'removed': 1, 'unchanged': 1})
+        self.assertFalse(os.path.exists(os.path.join(self.dst, 'a.png')))
+        self.assertTrue(os.path.exists(os.path.join(self.dst, 'ucomment.css')))
+
+        # Comment images are never removed
+        os.remove(os.path.join(self.src, 'b.png'))
+        counts = mediasync.sync_directory(self.src, self.dst, remove=False)
+        self.assertEqual(counts['removed'], 0)
+        self.assertTrue(os.path.exists(os.path.join(self.dst, 'b.png')))
+
+    def test_damaged_manifest(self):
+        mediasync.sync_directory(self.src, self.dst)
+        manifest = os.path.join(self.dst, mediasync.MANIFEST_NAME)
+        with open(manifest, 'rb') as f_handle:
+            contents = f_handle.read()
+        with open(manifest, 'wb') as f_handle:
+            f_handle.write(contents[:len(contents) // 2])
+        self.assertEqual(mediasync.load_manifest(self.dst), {})
+
+        # Every file is transferred again, and the manifest is rewritten
+        counts = mediasync.sync_directory(self.src, self.dst)
+        self.assertEqual(counts, {'copied': 3, 'removed': 0, 'unchanged': 0})
+        self.assertEqual(len(mediasync.load_manifest(self.dst)), 3)
+
+
+class Test_Comment_Images(TestCase):
+    """
+    Comment images are stored once, under the hash of their contents, and
+    removed when no comment uses them.
+    """
+    def setUp(self):
+        self.saved = (conf.MEDIA_ROOT, conf.MEDIA_URL, conf.comment_compile_area)
+        self.tempdir = tempfile.mkdtemp() + os.sep
+        conf.MEDIA_ROOT = self.tempdir + 'media' + os.sep
+        conf.MEDIA_URL = '/media/'
+        conf.comment_compile_area = self.tempdir + 'compile'
+        self.mathdir = os.sep.join([conf.comment_compile_area, '_build',
+                                    'pickle', '_images', 'math', ''])
+        ensuredir(self.mathdir)
+        for name in ('one.png', 'two.png'):
+            with open(self.mathdir + name, 'wb') as f_handle:
+                f_handle.write('same image')
+
+    def tearDown(self):
+        conf.MEDIA_ROOT, conf.MEDIA_URL, conf.comment_compile_area = self.saved
+        shutil.rmtree(self.tempdir)
+
+    def test_store_and_sweep(self):
+        html = views.transfer_html_media('<img src="_images/math/one.png"/>'
+                                         '<img src="_images/math/two.png"/>')
+        names = re.findall(r'src="/media/comments/(.*?)"', html)
+        self.assertEqual(len(names), 2)
+        self.assertEqual(names[0], names[1])
+        self.assertEqual(os.listdir(conf.MEDIA_ROOT + 'comments'), [names[0]])
+
+        # Recently written images are kept, even when no comment uses them
+        self.assertEqual(views.sweep_comment_images(ttl_hours=1)['removed'], 0)
+
+        models = views.models
+        page = models.Page.objects.create(link_name='chapter', body='',
+                                          sidebar='')
+        poster = models.CommentPoster.objects.create(long_name='Poster',
+                                                     name='Poster')
+        ref = models.CommentReference.objects.create(revision_changeset='1',
+                        file_name='chapter.rst', page_link_name='chapter',
+                        node_type='paragraph', line_number=1,
+                        comment_root='AAAAAA')
+        comment = models.Comment.objects.create(page=page, poster=poster,
+                                      reference=ref, node='x1', parent='AAAAAA',
+                                      IP_address='127.0.0.1', comment_HTML=html)
+        report = views.sweep_comment_images(ttl_hours=0)
+        self.assertEqual(report['uses'], {names[0]: 1})
+        self.assertEqual(report['removed'], 2)  # the compile area's images
+        self.assertTrue(os.path.exists(conf.MEDIA_ROOT + 'comments' + os.sep +
+                                       names[0]))
+
+        models.Comment.objects.filter(pk=comment.pk).update(is_rejected=True)
+        self.assertEqual(views.sweep_comment_images(ttl_hours=0)['removed'], 1)
+        self.assertEqual(os.listdir(conf.MEDIA_ROOT + 'comments'), [])
+
+
 class Test_RST_File_Changes(TestCase):
     """
     Snippets of RST file contents are presented and commented on.
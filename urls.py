@@ -21,9 +21,13 @@ urlpatterns = patterns('',
     # User initiated via the search box (more common): using a "POST" query
     url(r'^_search/$', views.search_document, name='ucomment-search-document'),
     # User initiated via the URL (not expected to be used): using a "GET" query
-    url(r'^_search/(?P<search_terms>.*?)(?P<search_type>/+.*?){0,1}(?P<with_case>/+case=.*?){0,1}$',
+    # The optional result page is given by ``/offset=20/limit=10`` at the end.
+    url(r'^_search/(?P<search_terms>.*?)(?P<search_type>/+\w*?){0,1}(?P<with_case>/+case=\w*?){0,1}(?P<offset>/+offset=\d+){0,1}(?P<limit>/+limit=\d+){0,1}/*$',
      views.search_document, name='ucomment-search-document-GET'),
 
+    # XHR (Javascript): search results as JSON, used for instant search
+    url(r'^_search-api/$', views.search_api, name='ucomment-search-api'),
+
     url(r'^_retrieve-page-name/$', views.retrieve_page_name, name='ucomment-retrieve-pagename'),
 
     # XHR path to the server: Javascript uses this to preview user's comment
@@ -53,6 +57,12 @@ urlpatterns = patterns('',
     # Author uses this to publish a new version to the web
     url(r'^_publish-update-document/$', views.publish_update_document, name='ucomment-publish-update-document'),
 
+    # Author can preview the files and pages that the next publish will change
+    url(r'^_publish-plan/$', views.publish_plan, name='ucomment-publish-plan'),
+
+    # XHR: the progress of a (background) publish job, as JSON
+    url(r'^_publish-status/(?P<job_id>\d+)/$', views.publish_job_status, name='ucomment-publish-status'),
+
     # Dump fixtures to file for backups
     url(r'^_dump_fixtures/$', views.dump_relevent_fixtures, name='ucomment-dump-fixtures'),
 )
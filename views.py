@@ -22,9 +22,14 @@ Also provide option NOT to send an email at all (simply reject the posting).
 
 # Standard library imports
 import os, sys, random, subprocess, pickle, re, logging.handlers, datetime
-import smtplib, time, shutil
+import smtplib, time, shutil, heapq, threading, inspect, cProfile, pstats
+import urllib
 from collections import defaultdict, namedtuple
 from StringIO import StringIO
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
 
 # Settings for the ucomment application
 from conf import settings as conf
@@ -38,6 +43,8 @@ from django.core import serializers
 from django.core.context_processors import csrf
 from django.core.mail import send_mail, BadHeaderError
 from django.http import HttpResponse, HttpResponseRedirect
+from django.db import connection, transaction
+from django.db.models import F, Q
 from django.core.urlresolvers import reverse as django_reverse
 from django.utils import simplejson            # used for XHR returns
 from django.utils import html as django_html   # used for clean search results
@@ -54,6 +61,9 @@ if conf.repo_DVCS_type == 'hg':
     dvcs.executable = conf.repo_DVCS_exec
     dvcs.local_repo_physical_dir = conf.local_repo_physical_dir
 
+# Transfers the images created by Sphinx to the webserver's media directory
+import mediasync
+
 # Import the application's models, without knowing the application name.
 models = getattr(__import__(conf.app_dirname, None, None, ['models']),'models')
 
@@ -421,11 +431,20 @@ def compile_RST_to_HTML(raw_RST):
     # and rewrite the URL's in the HTML.
     return transfer_html_media(html_body)
 
+# Images (equations) in the compiled comment HTML, and in the stored comments
+COMMENT_MATH_RE = re.compile(r'src="_images/math/([^"/]+)"')
+COMMENT_IMAGE_RE = re.compile(r'comments/([^"/]+)"')
+
 def transfer_html_media(html_body):
     """
     Any media files referred to in the HTML comment are transferred to a
     sub-directory on the webserver.
 
+    Each image is stored under the hash of its contents (see
+    ``mediasync.store_by_hash``), so it is only written once, no matter how
+    many comments (or previews) use it.  Images that are no longer used are
+    removed by ``sweep_comment_images``.
+
     The links are rewritten to refer to the updated location.
     """
     mathdir = ''.join([conf.comment_compile_area, os.sep, '_build', os.sep,
@@ -434,15 +453,62 @@ def transfer_html_media(html_body):
     dst_dir = conf.MEDIA_ROOT + 'comments' + os.sep
     ensuredir(dst_dir)
 
-    for mathfile in os.listdir(mathdir):
-        shutil.copyfile(mathdir + mathfile, dst_dir + mathfile)
-
-    src_prefix = 'src="'
-    math_prefix = '_images' + os.sep + 'math' + os.sep
-    replacement_text = ''.join([src_prefix, conf.MEDIA_URL,
-                                'comments', os.sep])
-    html_body = re.sub(src_prefix + math_prefix, replacement_text, html_body)
-    return html_body
+    stored = {}
+    def store_image(match):
+        """ Stores the image once; returns its new ``src`` attribute."""
+        name = match.group(1)
+        if name not in stored:
+            try:
+                stored[name] = mediasync.store_by_hash(mathdir + name, dst_dir)
+            except (IOError, OSError):
+                return match.group(0)
+        return 'src="%scomments/%s"' % (conf.MEDIA_URL, stored[name])
+
+    return COMMENT_MATH_RE.sub(store_image, html_body)
+
+def sweep_comment_images(ttl_hours=None, dry_run=False):
+    """
+    Removes the comment images (see ``transfer_html_media``) that are not used
+    by any comment (that was not rejected) and were last written more than
+    ``ttl_hours`` ago: these come from comments that were previewed, but never
+    submitted.  Old images in the comment compile area are also removed.
+
+    Returns a dictionary with the number of images ``removed`` and ``kept``,
+    and the number of comments that use each kept image, ``uses``.
+    """
+    if ttl_hours is None:
+        ttl_hours = conf.comment_image_ttl_hours
+    cutoff = time.time() - ttl_hours * 3600
+    uses = defaultdict(int)
+    for html in models.Comment.objects.filter(is_rejected=False)\
+                                .values_list('comment_HTML', flat=True)\
+                                .iterator():
+        for name in set(COMMENT_IMAGE_RE.findall(html)):
+            uses[name] += 1
+
+    report = {'removed': 0, 'kept': 0, 'uses': {}}
+    dst_dir = conf.MEDIA_ROOT + 'comments' + os.sep
+    mathdir = ''.join([conf.comment_compile_area, os.sep, '_build', os.sep,
+                       'pickle', os.sep, '_images', os.sep, 'math', os.sep])
+    for directory, in_use in ((dst_dir, uses), (mathdir, {})):
+        if not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            filename = directory + name
+            if name.startswith('.') or not os.path.isfile(filename):
+                continue
+            if name in in_use or os.path.getmtime(filename) > cutoff:
+                if directory == dst_dir:
+                    report['kept'] += 1
+                    report['uses'][name] = in_use.get(name, 0)
+                continue
+            if not dry_run:
+                os.remove(filename)
+            report['removed'] += 1
+
+    log_file.info('SWEEP: %(removed)d comment images removed; %(kept)d kept.' \
+                  % report)
+    return report
 
 
 def create_poster(request):
@@ -540,7 +606,8 @@ def submit_and_store_comment(request):
 
         # This will only occur in the exceptional case when the document
         # has been republished, and the user still has a previous version in
-        # their browser.  Hence the page reload request.
+        # their browser.  Hence the page reload request.  Unchanged nodes keep
+        # their root when republished, so only edited paragraphs lead here.
         response.write(('<p>A minor error occurred while processing your '
                         'comment.<p>The only way to correct it is to reload '
                         'the page you are on, and to resubmit your comment. '
@@ -560,7 +627,7 @@ def submit_and_store_comment(request):
     # ForeignKey: page object; get the page on which the comment appears
     # -----------------------
     link_name = convert_web_name_to_link_name(request.POST['page_name'])
-    c_page = models.Page.objects.filter(link_name=link_name)[0]
+    c_page = models.Page.objects.filter(link_name=link_name).only('pk')[0]
 
     # ForeignKey: comment poster objects
     # -----------------------------------
@@ -1342,8 +1409,9 @@ def render_page_for_web(page, request, search_value=''):
     search box.
     """
     try:
+        # Only used to compare against ``page``: don't load the page contents
         toc_page = models.Page.objects.filter(is_toc=True).filter(
-                                                            prev_link=None)[0]
+                                            prev_link=None).only('pk')[0]
         toc_link = models.Link(link=django_reverse('ucomment-root'),
                                title='Table of contents')
     except IndexError:
@@ -1525,7 +1593,7 @@ def display_page(page_requested):
         # Requested the master_doc (main document)
         if link_name == '':
             toc_page = models.Page.objects.filter(is_toc=True).filter(\
-                                                            prev_link=None)
+                                        prev_link=None).only('link_name')
             if toc_page:
                 resp = django_reverse('ucomment-root') + toc_page[0].link_name
                 return HttpResponseRedirect(resp)
@@ -1538,7 +1606,8 @@ def display_page(page_requested):
                                        conf.application_path,
                                        django_reverse('ucomment-admin-signin')))
                 return HttpResponse(emsg)
-        elif models.Page.objects.filter(link_name=link_name + '/index'):
+        elif models.Page.objects.filter(link_name=link_name + '/index')\
+                                                                    .exists():
             # To accommodate a peculiar Sphinx settings for PickleHTMLBuilder
             # It may lead to broken links for images that are included on
             # this page.
@@ -1551,8 +1620,10 @@ def display_page(page_requested):
             return HttpResponse('Page not found', status=404)
 
     page = item[0]
+    # Only update the visit counter, rather than saving the entire page again
+    models.Page.objects.filter(pk=page.pk).update(
+                            number_of_HTML_visits=F('number_of_HTML_visits') + 1)
     page.number_of_HTML_visits += 1
-    page.save()
 
     result = render_page_for_web(page, page_requested)
     log_file.info('REQUEST: page = %s from IP=%s; rendered in %f secs.' % (
@@ -1698,12 +1769,13 @@ def retrieve_page_name(request):
     if request.method == 'POST':
         page_name = request.POST.get('_page_name_', '')
         link_name = convert_web_name_to_link_name(page_name)
-        item = models.Page.objects.filter(link_name=link_name)
+        item = models.Page.objects.filter(link_name=link_name).only(
+                                                                'html_title')
         if not item:
             # Requested the master_doc (main document)
             if link_name == '':
                 toc_page = models.Page.objects.filter(is_toc=True).filter(\
-                                                                prev_link=None)
+                                            prev_link=None).only('html_title')
                 item = toc_page
             #elif models.Page.objects.filter(link_name=link_name + '/index'):
                 ## To accommodate a peculiar Sphinx settings for PickleHTMLBuilder
@@ -1727,43 +1799,403 @@ def retrieve_page_name(request):
 
 # Publishing update functions
 # ----------------------------
+# Only one publish may run at a time in this process.  The database is also
+# checked for running jobs, in case there are several web server processes.
+publish_lock = threading.Lock()
+
+# The progress of the publish jobs running in this process: job id -> dict of
+# ``PublishJob`` fields.  The page counts are only available from here while
+# the job's database transaction is still open.
+publish_progress = {}
+
+def set_publish_progress(job_id, save=False, **fields):
+    """
+    Records the progress of publish job ``job_id``, which may be None when
+    publishing outside of a job (e.g. in the unit tests).  The ``fields`` are
+    only written to the database if ``save`` is True.
+    """
+    if job_id is None:
+        return
+    publish_progress.setdefault(job_id, {}).update(fields)
+    if save:
+        models.PublishJob.objects.filter(pk=job_id).update(**fields)
+
+def active_publish_job():
+    """
+    Returns the publish job that is queued or running, or None.  Jobs that have
+    run for longer than ``conf.publish_job_timeout`` are marked as failed.
+    """
+    now = datetime.datetime.now()
+    cutoff = now - datetime.timedelta(seconds=conf.publish_job_timeout)
+    models.PublishJob.objects.filter(status__in=('queued', 'running'),
+                                     started_on__lt=cutoff).update(
+                    status='failed', finished_on=now,
+                    message='The publish job did not finish: timed out.')
+    try:
+        return models.PublishJob.objects.filter(status__in=('queued',
+                                        'running')).order_by('-started_on')[0]
+    except IndexError:
+        return None
+
 def publish_update_document(request):
     """
     After pages have been remotely updated and checked back in; the author
     must trigger an update.  This compiles the code to HTML for the changed
     files, created database entries for each node, regenerates the PDF output.
+
+    The publishing runs as a background job: the response is a page that
+    follows the job's progress.  Only one job may run at a time.
     """
     if not request.user.is_authenticated():
         return HttpResponseRedirect(django_reverse('ucomment-admin-signin'))
 
-    msg = call_sphinx_to_publish()
+    # A full publish (``?force=1``) recompiles, and rewrites, every page.
+    force = request.GET.get('force', '') not in ('', '0', 'false', 'False')
+
+    if publish_lock.acquire(False):
+        running = active_publish_job()
+        if running:
+            publish_lock.release()
+    else:
+        running = active_publish_job()
+        if running is None:
+            # The job has timed out, but is still busy in this process
+            return HttpResponse('Another publish is still running.',
+                                status=409)
+    if running:
+        log_file.info('PUBLISH: request ignored; job %d is still running.' % \
+                                                                    running.pk)
+        return HttpResponse(publish_status_page(running, ('Another publish '
+                            'is already running; showing its progress.')),
+                            status=409)
+
+    try:
+        job = models.PublishJob.objects.create(force=force)
+        worker = threading.Thread(target=run_publish_job, args=(job.pk, force))
+        worker.setDaemon(True)
+        worker.start()
+    except Exception:
+        publish_lock.release()
+        raise
 
-    # An empty message, msg, indicates no problems.  Any problems that may
-    # have occurred have already been emailed and logged to the admin user.
-    if msg:
-        return HttpResponse(msg, status=404)
+    log_file.info('PUBLISH: started publish job %d (force = %s)' % (job.pk,
+                                                                    force))
+    return HttpResponse(publish_status_page(job), status=200)
 
-    # TODO(KGD):  Convert any changed images to JPG from PNG.
-    #             Compile PDF here, or even earlier.
-    #             Update search index tables in Sphinx search
-    msg = 'PUBLISH: Update and publish operation successfully completed'
-    log_file.info(msg)
-    msg += ('<br><p>View your document <a href="%s">from this link</a>'
-        '.</p>') % (django_reverse('ucomment-root'))
+def run_publish_job(job_id, force=False):
+    """
+    Publishes the document in a background thread, and records the outcome in
+    ``PublishJob`` number ``job_id``.  Releases the ``publish_lock`` when done.
+    """
+    try:
+        set_publish_progress(job_id, save=True, status='running')
+        profile = None
+        if conf.publish_profile:
+            profile = cProfile.Profile()
+        try:
+            if profile:
+                msg = profile.runcall(call_sphinx_to_publish, force=force,
+                                      job_id=job_id)
+            else:
+                msg = call_sphinx_to_publish(force=force, job_id=job_id)
+        except Exception as err:
+            msg = 'An unexpected error occurred while publishing: %s' % str(err)
+            UcommentError(err, 'While publishing the document.')
+
+        # Add the slowest functions to the job's report
+        if profile:
+            stats = StringIO()
+            pstats.Stats(profile, stream=stats).sort_stats('cumulative')\
+                                                            .print_stats(40)
+            report = publish_progress.get(job_id, {}).get('report', '')
+            set_publish_progress(job_id, save=True, report=report + \
+                                 '\n\nProfile:\n' + stats.getvalue())
+
+        # An empty message, msg, indicates no problems.  Any problems that may
+        # have occurred have already been emailed and logged to the admin user.
+        if msg:
+            status = 'failed'
+        else:
+            status = 'succeeded'
+            # TODO(KGD):  Convert any changed images to JPG from PNG.
+            #             Compile PDF here, or even earlier.
+            log_file.info(('PUBLISH: Update and publish operation '
+                           'successfully completed'))
+        # A publish that had nothing to do keeps its "unchanged" phase: it is
+        # left out of ``estimate_publish_time``
+        phase = 'finished'
+        if publish_progress.get(job_id, {}).get('phase') == 'unchanged':
+            phase = 'unchanged'
+        set_publish_progress(job_id, save=True, status=status,
+                             phase=phase, message=msg,
+                             finished_on=datetime.datetime.now())
+    finally:
+        publish_progress.pop(job_id, None)
+        publish_lock.release()
+        # This thread's database connection is not closed by Django
+        connection.close()
+
+def publish_status_page(job, note=''):
+    """
+    Returns the HTML for a page that polls the progress of the publish ``job``
+    until the job is finished.
+    """
+    return ('<p>%s</p><p>Publish job %d:</p><pre id="ucomment-publish-status">'
+            '%s</pre>'
+            '<script type="text/javascript">\n'
+            'var poll_status = function(){\n'
+            '  var xhr = new XMLHttpRequest();\n'
+            '  xhr.open("GET", "%s", true);\n'
+            '  xhr.onreadystatechange = function(){\n'
+            '    if (xhr.readyState != 4 || xhr.status != 200){ return; }\n'
+            '    var job = JSON.parse(xhr.responseText);\n'
+            '    var out = "Status: " + job.status + "\\nPhase: " + job.phase +'
+            '      "\\nPages: " + job.pages_processed + " of " + '
+            '      job.pages_total + "\\nElapsed: " + '
+            '      job.elapsed.toFixed(1) + " secs";\n'
+            '    if (job.message){ out += "\\n\\n" + job.message; }\n'
+            '    if (job.warnings){ out += "\\n\\nWarnings:\\n" + '
+            '      job.warnings; }\n'
+            '    if (job.report){ out += "\\n\\nTimings:\\n" + '
+            '      job.report; }\n'
+            '    document.getElementById("ucomment-publish-status")'
+            '      .innerHTML = out;\n'
+            '    if (job.status == "queued" || job.status == "running"){\n'
+            '      setTimeout(poll_status, 2000);\n'
+            '    }\n'
+            '  };\n'
+            '  xhr.send(null);\n'
+            '};\n'
+            'poll_status();\n'
+            '</script>'
+            '<p>View your document <a href="%s">from this link</a>.</p>') % (
+                note, job.pk, job.status,
+                django_reverse('ucomment-publish-status', args=[job.pk]),
+                django_reverse('ucomment-root'))
+
+def publish_job_status(request, job_id):
+    """
+    Returns the progress of a publish job as JSON: used to refresh the page
+    shown to the author while publishing.
+    """
+    if not request.user.is_authenticated():
+        return HttpResponseRedirect(django_reverse('ucomment-admin-signin'))
+    try:
+        job = models.PublishJob.objects.get(pk=int(job_id))
+    except models.PublishJob.DoesNotExist:
+        return HttpResponse('', status=404)
+
+    status = {'id': job.pk,
+              'status': job.status,
+              'force': job.force,
+              'phase': job.phase,
+              'pages_processed': job.pages_processed,
+              'pages_total': job.pages_total,
+              'warnings': django_html.escape(job.warnings),
+              'elapsed': job.elapsed(),
+              'revision_changeset': job.revision_changeset,
+              'message': django_html.escape(job.message),
+              'report': django_html.escape(job.report)}
+
+    # The progress of a job in this process is more up to date
+    progress = publish_progress.get(job.pk, {})
+    for key in ('status', 'phase', 'pages_processed', 'pages_total'):
+        if key in progress:
+            status[key] = progress[key]
+    return HttpResponse(simplejson.dumps(status),
+                        mimetype='application/javascript')
+
+
+def last_published_revision():
+    """
+    Returns the revision changeset of the last successful publish, or None if
+    the document has not been published yet.
+    """
+    revisions = models.PublishJob.objects.filter(status='succeeded').exclude(
+                        revision_changeset='').order_by('-finished_on')\
+                        .values_list('revision_changeset', flat=True)[:1]
+    if not revisions:
+        # Published before publish jobs were recorded
+        revisions = models.Page.objects.exclude(link_name='_orphans_')\
+                        .values_list('revision_changeset', flat=True)[:1]
+    if revisions:
+        return revisions[0]
+    return None
+
+def publish_fingerprint():
+    """
+    Returns a fingerprint of the settings and code that affect the published
+    document: the application's version, its settings file, the ucomment
+    extension and the modules that publish the document.  The document's own
+    ``conf.py`` is in the repository, so it is covered by the revision
+    changeset.
+    """
+    digest = md5(str(conf.ucomment_ver))
+    for filename in (os.path.join('conf', 'settings.py'),
+                     os.path.join('sphinx-extensions', 'ucomment-extension.py'),
+                     'views.py', 'models.py', 'mediasync.py'):
+        digest.update(mediasync.file_hash(os.path.join(conf.application_path,
+                                                       filename)))
+    return digest.hexdigest()
+
+def publish_unchanged(revision_changeset, fingerprint):
+    """
+    Returns True if the last successful publish job published
+    ``revision_changeset`` with settings of the same ``fingerprint``: then
+    publishing again would not change anything.
+    """
+    jobs = models.PublishJob.objects.filter(status='succeeded').exclude(
+                        revision_changeset='').order_by('-finished_on')\
+                        .values_list('revision_changeset', 'settings_hash')[:1]
+    return bool(jobs) and tuple(jobs[0]) == (revision_changeset, fingerprint)
+
+def estimate_publish_time(force=False, history=10):
+    """
+    Estimates how many seconds a publish will take: the median time of the
+    last ``history`` successful publish jobs of the same kind (``force`` or
+    not).  Jobs that had nothing to publish (see ``publish_unchanged``) are
+    not counted.  Returns None if there are no such jobs yet.
+    """
+    jobs = models.PublishJob.objects.filter(status='succeeded', force=force,
+                            finished_on__isnull=False).exclude(
+                            phase='unchanged').order_by('-finished_on')
+    times = sorted(job.elapsed() for job in jobs[:history])
+    if not times:
+        return None
+    return times[len(times) // 2]
+
+def plan_publish(force=False):
+    """
+    Works out what a publish would change, without running Sphinx: the files
+    changed since the last published revision, the pages generated from those
+    files, and the number of comment references on these pages.  The local
+    repository is first updated from the remote repository, as for a publish.
+
+    Returns a dictionary.  Every page is rewritten (``all_pages`` is True) for
+    a forced publish, for the first publish, or when the document's
+    ``conf.py`` has changed.
+    """
+    revision_to = update_local_repo()
+    revision_from = last_published_revision()
+    plan = {'revision_from': revision_from,
+            'revision_to': revision_to,
+            'files': [],
+            'pages': [],
+            'references': 0,
+            'all_pages': force or revision_from is None,
+            'estimate': estimate_publish_time(force)}
+    if revision_from is not None and revision_from != revision_to:
+        plan['files'] = dvcs.changed_files(revision_from, revision_to)
+
+    # A source file can be split over several pages
+    source_pages = defaultdict(list)
+    for source_name, link_name in models.Page.objects.exclude(
+            link_name='_orphans_').values_list('source_name', 'link_name'):
+        source_pages[source_name].append(link_name)
+
+    repo_dir = os.path.abspath(conf.local_repo_physical_dir)
+    touched = set()
+    for status, file_name in plan['files']:
+        full_name = os.path.join(repo_dir, file_name)
+        if full_name in source_pages:
+            touched.update(source_pages[full_name])
+        elif os.path.basename(file_name) == 'conf.py':
+            plan['all_pages'] = True
+
+    if plan['all_pages']:
+        for link_names in source_pages.itervalues():
+            touched.update(link_names)
+        plan['references'] = models.CommentReference.objects.count()
+    else:
+        for link_names in chunked(list(touched)):
+            plan['references'] += models.CommentReference.objects.filter(
+                                    page_link_name__in=link_names).count()
+    plan['pages'] = sorted(touched)
+    return plan
+
+def publish_plan(request):
+    """
+    Shows the author what the next publish will change, before publishing.
+    """
+    if not request.user.is_authenticated():
+        return HttpResponseRedirect(django_reverse('ucomment-admin-signin'))
+
+    force = request.GET.get('force', '') not in ('', '0', 'false', 'False')
+
+    # Don't update the repository underneath a running publish job
+    if not publish_lock.acquire(False):
+        return HttpResponse('A publish is running; please try again later.',
+                            status=409)
+    try:
+        if active_publish_job():
+            return HttpResponse(('A publish is running; please try again '
+                                 'later.'), status=409)
+        plan = plan_publish(force)
+    finally:
+        publish_lock.release()
+
+    esc = django_html.escape
+    if plan['estimate'] is None:
+        estimate = 'unknown (no previous publishes)'
+    else:
+        estimate = 'about %.0f seconds' % plan['estimate']
+    files = ''.join('<li>%s %s</li>' % (esc(status), esc(file_name))
+                    for status, file_name in plan['files'])
+    pages = ''.join('<li>%s</li>' % esc(link_name)
+                    for link_name in plan['pages'])
+    if plan['all_pages']:
+        note = '<p>Every page will be rewritten.</p>'
+    else:
+        note = ''
+    msg = ('<p>Publishing revision %s; last published revision: %s.</p>'
+           '<p>Changed files:</p><ul>%s</ul>%s'
+           '<p>Pages to update:</p><ul>%s</ul>'
+           '<p>Comment references on these pages: %d</p>'
+           '<p>Estimated publishing time: %s.</p>'
+           '<p><a href="%s%s">Publish now</a></p>') % (
+                esc(plan['revision_to']), esc(plan['revision_from'] or 'none'),
+                files or '<li>none</li>', note, pages or '<li>none</li>',
+                plan['references'], estimate,
+                django_reverse('ucomment-publish-update-document'),
+                force and '?force=1' or '')
     return HttpResponse(msg, status=200)
 
 
-def call_sphinx_to_publish():
+def call_sphinx_to_publish(force=False, job_id=None):
     """ Does the work of publishing the latest version of the document.
 
     Pulls in the latest revision from the DVCS, publishes the document.
+
+    Only the pages that have changed are written to the database, unless
+    ``force`` is True: then Sphinx recompiles all the RST files and every page
+    is rewritten.  Nothing is compiled if the revision and settings are the
+    same as for the last successful publish, unless ``force`` is True.
+
+    The progress is recorded in ``PublishJob`` number ``job_id``, if given,
+    along with a report of the time taken by each phase of the publish.
     """
-    # TODO(KGD): can we show a list of changed files to the author before
-    #            s/he clicks "Publish": you will have to dig into Sphinx's
-    #            internals to see that.
+    # A list of the changed files is shown before publishing by
+    # ``publish_plan``.
+    timer = PhaseTimer()
+    set_publish_progress(job_id, save=True, phase='updating repository')
     revision_changeset = update_local_repo()
+    timer.lap('update repository')
     log_file.info('PUBLISH: the document with revision changeset = %s' % \
                    revision_changeset)
+    fingerprint = publish_fingerprint()
+    if not force and publish_unchanged(revision_changeset, fingerprint):
+        log_file.info(('PUBLISH: revision and settings are unchanged since the '
+                       'last publish; nothing to do.'))
+        set_publish_progress(job_id, save=True, phase='unchanged',
+                             revision_changeset=revision_changeset,
+                             settings_hash=fingerprint,
+                             report=timer.as_text())
+        return ''
+
+    # The fingerprint is only recorded once the document has been committed
+    # to the database (see ``publish_unchanged``).
+    set_publish_progress(job_id, save=True, phase='compiling',
+                         revision_changeset=revision_changeset)
 
     # Copy over the ucomment extension to the local repo: that way the author
     # does not have to include it in his/her repo of the document.
@@ -1795,9 +2227,6 @@ def call_sphinx_to_publish():
     # TODO(KGD): can we send this to the logfile instead of status and warning?
     #            will allow us to track compiling of large documents via logfile
 
-    # TODO(KGD): investigate using http://ajaxpatterns.org/Periodic_Refresh
-    # also see: http://www.ajaxprojects.com/ajax/tutorialdetails.php?itemid=9
-
     # The code below simulates the command-line call
     # $ sphinx-build -a -b pickle -d _build/doctrees . _build/pickle
 
@@ -1812,32 +2241,29 @@ def call_sphinx_to_publish():
     # Note: FRESHENV: if True: we must delete all previous comment references,
     # to avoid an accumulation of references in the database.
     conf.use_freshenv = False
+    sphinx_args = {'srcdir': conf.local_repo_physical_dir,
+                   'confdir': conf.local_repo_physical_dir,
+                   'outdir': build_dir + os.sep + 'pickle',
+                   'doctreedir': build_dir + os.sep + 'doctrees',
+                   'buildername': 'pickle',
+                   'status': status,
+                   'warning': warning,
+                   'freshenv': conf.use_freshenv,
+                   'warningiserror': False,
+                   'tags': []}
+
+    # Sphinx 1.3 and newer can read the RST files using several processes
+    if 'parallel' in inspect.getargspec(Sphinx.__init__)[0]:
+        sphinx_args['parallel'] = conf.publish_parallel
     try:
-        app = Sphinx(srcdir=conf.local_repo_physical_dir,
-                     confdir=conf.local_repo_physical_dir,
-                     outdir = build_dir + os.sep + 'pickle',
-                     doctreedir = build_dir + os.sep + 'doctrees',
-                     buildername = 'pickle',
-                     status = status,
-                     warning = warning,
-                     freshenv = conf.use_freshenv,
-                     warningiserror = False,
-                     tags = [])
+        app = Sphinx(**sphinx_args)
+        timer.lap('sphinx: setup')
 
         if app.builder.name != 'pickle':
             emsg = ('Please use the Sphinx "pickle" builder to compile the '
                     'RST files.')
             log_file.error(emsg)
-            # TODO(KGD): return HttpResponse object still
-            return
-
-        # We also want to compile the documents using the text builder (search).
-        # But rather than calling Sphinx from the start, just create a text
-        # builder and run it right after the pickle builder.  Any drawbacks?
-        text_builder_cls = getattr(__import__('sphinx.builders.text', None,
-                                    None, ['TextBuilder']), 'TextBuilder')
-        text_builder = text_builder_cls(app)
-        pickle_builder = app.builder
+            return emsg
 
         if 'ucomment' not in app.env.config:
             emsg = ('The document was not published: please ensure the '
@@ -1846,10 +2272,26 @@ def call_sphinx_to_publish():
             UcommentError(emsg)
             return emsg
 
-        # Call the ``pickle`` builder
+        # Call the ``pickle`` builder.  This is the only Sphinx build: the
+        # search text is taken from the RST sources when the pages are saved
+        # to the database, so a text build is not required.
         app.env.config.ucomment['revision_changeset'] = revision_changeset
-        app.env.config.ucomment['skip-cleanup'] = True
-        app.build()
+        app.env.config.ucomment['skip-cleanup'] = False
+
+        # Roots that have been commented on are never given to another node,
+        # even once they are no longer in the document (their comments are
+        # orphans, until the node is brought back).
+        app.env.config.ucomment['used_roots'].update(
+                    models.CommentReference.objects.filter(
+                    comment_root_is_used=True).values_list('comment_root',
+                                                           flat=True))
+        # The other roots are only reused by a node on the same page: the
+        # pages that are not rewritten keep their comment references.
+        app.env.config.ucomment['reference_roots'] = dict(
+                    models.CommentReference.objects.values_list(
+                    'comment_root', 'page_link_name').iterator())
+        app.build(force)
+        timer.lap('sphinx: build')
 
         # Log any warnings to the logfile.
         log_file.info('PUBLISH: Sphinx compiling HTML (pickle) successfully.')
@@ -1858,28 +2300,6 @@ def call_sphinx_to_publish():
             for line in warning.readlines():
                 log_file.warn('PUBLISH: ' + line)
 
-        # Now switch to the text builder (to create the search index)
-        app.env.config.ucomment['skip-cleanup'] = False
-        app.builder = text_builder
-
-        try:
-            app.build()
-        except SphinxError as e:
-            log_file.warn(('PUBLISH: could not successfully publish the text-'
-                           'based version of the document (used for searching).'
-                           'Error reported = %s') % str(e))
-            # TODO(KGD): defer clean-up to after RST files are used as search
-
-        log_file.debug('PUBLISH: Sphinx compiling TEXT version successfully.')
-        if warning.tell():
-            warning.seek(0)
-            for line in warning.readlines():
-                log_file.warn('PUBLISH WARNING: ' + line.strip())
-
-        # Switch back to the pickle builder (we need this when doing the
-        # database commits)
-        app.builder = pickle_builder
-
     except SphinxError as e:
         msg = 'A Sphinx error occurred (error type = %s): %s'  % \
             (e.category, str(e))
@@ -1888,14 +2308,124 @@ def call_sphinx_to_publish():
         return msg
 
     if app.statuscode == 0:
-        commit_updated_document_to_database(app)
+        set_publish_progress(job_id, save=True, phase='saving pages',
+                             warnings=warning.getvalue())
+        n_pages = commit_updated_document_to_database(app, force=force,
+                                                      job_id=job_id,
+                                                      timer=timer)
+        set_publish_progress(job_id, save=True, pages_processed=n_pages,
+                             pages_total=n_pages, settings_hash=fingerprint)
+
+        # The ucomment extension times the phases inside the Sphinx build
+        timer.build_phases = app.env.config.ucomment.get('timings', [])
+        log_file.info('PUBLISH: timings: ' + timer.report())
+        set_publish_progress(job_id, save=True, report=timer.as_text())
     else:
-        log_file.error(('The Sphinx status code was non-zero.  Please check '
-                        'lines in the log file above this one for more info.'))
+        emsg = ('The Sphinx status code was non-zero.  Please check lines in '
+                'the log file above this one for more info.')
+        log_file.error(emsg)
+        return emsg
     return ''
 
 
-def commit_updated_document_to_database(app):
+class PhaseTimer(object):
+    """
+    Times the phases of a long operation, such as publishing the document, so
+    the time spent in each phase can be reported in the log file.
+    """
+    def __init__(self):
+        self.phases = []
+        self.start_time = self.lap_time = time.time()
+        # Phases timed elsewhere, e.g. by the ucomment extension inside the
+        # Sphinx build: a list of ``(phase, duration)`` tuples
+        self.build_phases = []
+        # Other figures to report, e.g. the number of pages: name -> number
+        self.counts = {}
+
+    def lap(self, phase):
+        """ Records the time spent in ``phase``: since the previous lap."""
+        now = time.time()
+        self.phases.append((phase, now - self.lap_time))
+        self.lap_time = now
+
+    def report(self):
+        """ Returns a one-line summary of the time spent in each phase."""
+        out = ['%s = %.3f secs' % (phase, duration) for phase, duration in \
+                                                                self.phases]
+        out.append('total = %.3f secs' % (self.lap_time - self.start_time))
+        return '; '.join(out)
+
+    def as_text(self):
+        """
+        Returns a multi-line report of the phases, the phases timed inside the
+        Sphinx build and the counts; stored with each publish job.
+        """
+        out = ['%-32s %9.3f secs' % (phase, duration) for phase, duration in \
+                                                                self.phases]
+        out.append('%-32s %9.3f secs' % ('total',
+                                         self.lap_time - self.start_time))
+        if self.build_phases:
+            out.extend(['', 'Within the Sphinx build:'])
+            out.extend('%-32s %9.3f secs' % (phase, duration) for \
+                                            phase, duration in self.build_phases)
+        if self.counts:
+            out.append('')
+            out.extend('%-32s %9d' % (name, number) for name, number in \
+                                                    sorted(self.counts.items()))
+        return '\n'.join(out)
+
+def chunked(items, size=500):
+    """
+    Yields successive lists of at most ``size`` entries from ``items``; used to
+    keep ``pk__in=...`` queries within the database's limits.
+    """
+    items = list(items)
+    for idx in xrange(0, len(items), size):
+        yield items[idx:idx+size]
+
+def bulk_insert(model, objects):
+    """
+    Inserts the (unsaved) ``objects`` of type ``model`` in the database, using
+    as few queries as this version of Django allows.
+    """
+    if hasattr(model.objects, 'bulk_create'):
+        for batch in chunked(objects):
+            model.objects.bulk_create(batch)
+    else:
+        for obj in objects:
+            obj.save(force_insert=True)
+
+def page_content_hash(page_info, source, *extra):
+    """
+    Returns an MD5 hash of everything that is stored in the database for a
+    page: the page's pickled output from Sphinx (``page_info``), its RST
+    ``source`` and any ``extra`` strings that also affect the page.
+    """
+    digest = md5()
+    for item in [page_info['body'], page_info['title'], page_info['toc'],
+                 repr(page_info['parents']), repr(page_info['next']),
+                 repr(page_info['prev']), source] + list(extra):
+        if isinstance(item, unicode):
+            item = item.encode('utf-8')
+        digest.update(item)
+        digest.update('\0')
+    return digest.hexdigest()
+
+# The parts of a page's pickle file from Sphinx that are used when publishing.
+# The ``body``, ``toc`` and ``source`` fields are None if the page has not
+# changed since the last publish.  Then ``title``, ``parents``, ``next`` and
+# ``prev`` are also None if the page's pickle file was not loaded.
+PageRecord = namedtuple('PageRecord', ('link_name is_toc is_chapter_index '
+                                       'title body toc parents next prev '
+                                       'source_name source content_hash'))
+
+# File, in the Sphinx doctree directory, with a summary of each page when it
+# was last published: docname -> (stamp, link_name, next page, content hash)
+PAGE_SUMMARY_NAME = 'ucomment-pages.pickle'
+
+@transaction.commit_on_success
+def commit_updated_document_to_database(app, force=False, job_id=None,
+                                        timer=None):
     """
     Two types of objects must be commited to the database to complete the
     publishing of the document:
@@ -1905,33 +2435,101 @@ def commit_updated_document_to_database(app):
     We need to take some extra care with the comment references: remove unused
     comment references, find and take care of references that were orphaned
     (see below), and add new comment references.
+
+    The existing database rows are loaded once, up front, and only rows that
+    have changed are written back.  Everything is committed in a single
+    transaction, so visitors never see a half-published document.
+
+    Pages whose content hash (see ``page_content_hash``) has not changed since
+    the last publish are skipped, unless ``force`` is True.  The hash is saved
+    with the size and modification time of the page's pickle file and RST
+    source (in the ``PAGE_SUMMARY_NAME`` file in the doctree directory), so
+    the pickle and source of a page that Sphinx did not rewrite are not even
+    loaded.
+
+    The progress is recorded for the ``PublishJob`` number ``job_id``, if given.
+    The phases are timed, and the pages and references counted, by ``timer``.
+    Returns the number of pages published.
     """
     sphinx_settings = app.env.config.ucomment
+    if timer is None:
+        timer = PhaseTimer()
 
     # Used to convert ``class="reference internal"`` to
     # ``class="ucomment-internal-reference"``
     local_toc_re = re.compile(r'class="reference internal"')
     replace_toc = 'class="ucomment-internal-reference"'
 
-    # First, generate a dictionary of page_name -> next_page_name
+    # The content hash of every page: to check which pages have changed
+    prior_hashes = dict(models.Page.objects.values_list('link_name',
+                                                        'content_hash'))
+    summaries = mediasync.load_manifest(app.doctreedir, PAGE_SUMMARY_NAME)
+    new_summaries = {}
+
+    # Load each page's pickle file once, keeping only the fields that are used
+    # below.  At the same time, generate a dictionary of
+    # page_name -> next_page_name
     # The first page = TOC = app.env.config.master_doc
     # The last page  has no next page link.
     # E.g" {'toc': 'page1', 'page2': 'page3', 'page1': 'page2', 'page3': None}
     all_files = app.env.found_docs
     document_order = {}
+    records = {}
+    file_linkname_map = {}
     for fname in list(all_files):
-        is_toc = False
+        is_toc = is_chapter_index = False
+        if fname in app.env.config.ucomment['toc_docs']:
+            is_chapter_index = True
         if fname == app.env.config.master_doc:
             is_toc = True
+            is_chapter_index = False
 
         name = app.builder.outdir + os.sep + fname + app.builder.out_suffix
+        src = app.builder.srcdir + os.sep + fname + app.config.source_suffix
         try:
-            f = file(name, 'r')
-            page_info = pickle.load(f)
+            unsplit_source_name = sphinx_settings['split_sources'][src]
+        except KeyError:
+            unsplit_source_name = src
+
+        # Skip a page without loading it, if neither its pickle file nor its
+        # source has changed, and it was stored in the database with that hash
+        try:
+            name_stat, src_stat = os.stat(name), os.stat(src)
+            stamp = (name_stat.st_mtime, name_stat.st_size, src_stat.st_mtime,
+                     src_stat.st_size, is_toc, is_chapter_index,
+                     app.env.config.project, unsplit_source_name)
+        except OSError:
+            stamp = None
+        summary = summaries.get(fname)
+        if not force and stamp is not None and summary is not None and \
+                    summary[0] == stamp and \
+                    prior_hashes.get(summary[1]) == summary[3]:
+            _, link_name, next_section, content_hash = summary
+            new_summaries[fname] = summary
+            document_order[link_name] = next_section
+            file_linkname_map[app.srcdir + os.sep + fname + \
+                                     app.env.config.source_suffix] = link_name
+            records[fname] = PageRecord(link_name, is_toc, is_chapter_index,
+                                        None, None, None, None, None, None,
+                                        unsplit_source_name, None, content_hash)
+            continue
+
+        try:
+            with open(name, 'rb') as f_handle:
+                page_info = pickle.load(f_handle)
         except IOError:
             raise IOError('An IOError occurred when processing %s' % name)
-        finally:
-            f.close()
+        timer.counts['pages loaded'] = timer.counts.get('pages loaded', 0) + 1
+
+        # Aim: get a text version of each page to generate a search index
+        # Get the RST source code, clean it, and store that in the database.
+        # TOC and chapter indicies are not to be indexed for the search engine.
+        try:
+            with open(src, 'r') as f_handle:
+                source = f_handle.read()
+        except IOError:
+            raise IOError(('An IOError occurred when processing RST '
+                           'source file: %s' % src))
 
         # What is the page's HTML title?
         link_name = page_info['current_page_name']
@@ -1945,6 +2543,27 @@ def commit_updated_document_to_database(app):
             next_section = None
 
         document_order[link_name] = next_section
+        file_linkname_map[app.srcdir + os.sep + fname + \
+                                     app.env.config.source_suffix] = link_name
+
+        # Only keep the page's contents if something stored for it has changed
+        content_hash = page_content_hash(page_info, source, str(is_toc),
+                                         str(is_chapter_index),
+                                         app.env.config.project,
+                                         unsplit_source_name)
+        if prior_hashes.get(link_name) == content_hash and not force:
+            body = toc = source = None
+        else:
+            body, toc = page_info['body'], page_info['toc']
+        if stamp is not None:
+            new_summaries[fname] = (stamp, link_name, next_section,
+                                    content_hash)
+        records[fname] = PageRecord(link_name, is_toc, is_chapter_index,
+                                    page_info['title'], body, toc,
+                                    page_info['parents'], page_info['next'],
+                                    page_info['prev'], unsplit_source_name,
+                                    source, content_hash)
+        del page_info
 
     # Next, order the pages.  The ``ordered_names`` list will grow in size
     # TODO(KGD): The problem comes from how the document is split in
@@ -1963,83 +2582,85 @@ def commit_updated_document_to_database(app):
     ordered_names.extend(set(page_names) - set(ordered_names))
 
 
+    timer.lap('database: page order')
+
     # Now commit each (web)page to the DB in order
     # ---------------------------------------------
-    prior_pages = models.Page.objects.all()
-    file_linkname_map = {}
-    for fname in reversed(ordered_names):
-        is_toc = is_chapter_index = False
-        if fname in app.env.config.ucomment['toc_docs']:
-            is_chapter_index = True
-        if fname == app.env.config.master_doc:
-            is_toc = True
-            is_chapter_index = False
-
-        name = app.builder.outdir + os.sep + fname + app.builder.out_suffix
-        try:
-            f = file(name, 'r')
-            page_info = pickle.load(f)
-        except IOError:
-            raise IOError('An IOError occurred when processing %s' % name)
-        finally:
-            f.close()
-
-        # Aim: get a text version of each page to generate a search index
-        # Get the RST source code, clean it, and store that in the database.
-        # TOC and chapter indicies are not to be indexed for the search engine.
-
-        src = app.builder.srcdir + os.sep + fname + app.config.source_suffix
-        try:
-            unsplit_source_name = sphinx_settings['split_sources'][src]
-        except KeyError:
-            unsplit_source_name = src
+    # Load the existing links, pages and search text once, rather than
+    # querying the database for every page.
+    links = {}
+    for link in models.Link.objects.all():
+        links[(link.link, link.title)] = link
+
+    def get_link(link, title):
+        """ Returns the ``Link`` object, creating it only if it is new."""
+        key = (link, title)
+        if key not in links:
+            links[key] = models.Link.objects.create(link=link, title=title)
+        return links[key]
+
+    # The page bodies are only loaded (one at a time) for pages that changed
+    prior_pages = {}
+    for page in models.Page.objects.defer('body'):
+        prior_pages[page.link_name] = page
+    changed_pages = [prior_pages[record.link_name].pk for record in \
+                     records.itervalues() if record.link_name in prior_pages \
+                     and record.body is not None]
+    prior_search = {}
+    for pks in chunked(changed_pages):
+        for page_search in models.PageSearchText.objects.filter(page__in=pks):
+            prior_search[page_search.page_id] = page_search
+
+    new_search = []
+    published_pages = []
+    n_changed = 0
+    for idx, fname in enumerate(reversed(ordered_names)):
+        set_publish_progress(job_id, pages_processed=idx,
+                             pages_total=len(ordered_names))
+        # Release each record once it has been used
+        record = records.pop(fname, None)
+        if record is None:
+            continue    # appears more than once in the document order
+        is_toc = record.is_toc
+        is_chapter_index = record.is_chapter_index
+        link_name = record.link_name
+
+        # Skip the page if nothing stored for it has changed
+        page = prior_pages.get(link_name)
+        if record.body is None:
+            published_pages.append(page.pk)
+            continue
 
         if is_toc or is_chapter_index:
             # Good side-effect: TOC pages will never show up in search results
             search_text = ''
         else:
-            try:
-                f = file(src, 'r')
-                search_text = ''.join(f.readlines())
-                search_text = sanitize_search_text(search_text)
-            except IOError:
-                raise IOError(('An IOError occurred when processing RST '
-                               'source file: %s' % src))
-            finally:
-                f.close()
-
-        # By what name will the HTML page be accessed?
-        link_name = page_info['current_page_name']
+            search_text = sanitize_search_text(record.source)
 
         # Now get some link information to add to the page.  Not every
         # page has a parent; for those pages, set the parent to be the TOC.
         # The parent link for the TOC is the TOC
         try:
-            parent_link, _ = models.Link.objects.get_or_create(
-                link = page_info['parents'][0]['link'],
-                title = page_info['parents'][0]['title'])
+            parent_link = get_link(record.parents[0]['link'],
+                                   record.parents[0]['title'])
         except IndexError:
             # The highest level TOC does not have a parent: this is used
             # to correctly output the navigation bar.
             if is_toc:
                 parent_link = None
             else:
-                parent_link, _ = models.Link.objects.get_or_create(
-                    link = u'../',
-                    title = u'')
+                parent_link = get_link(u'../', u'')
 
         try:
-            next_link, _ = models.Link.objects.get_or_create(
-                link = page_info['next']['link'],
-                title = page_info['next']['title'])
+            next_link = get_link(record.next['link'],
+                                 record.next['title'])
         except TypeError:
             # Only the last section in the document won't have a next link
             next_link = None
 
         try:
-            prev_link, _ = models.Link.objects.get_or_create(
-                link = page_info['prev']['link'],
-                title = page_info['prev']['title'])
+            prev_link = get_link(record.prev['link'],
+                                 record.prev['title'])
         except TypeError:
             # Only the TOC won't have a previous link.  We rely on this fact to
             # filter the pages to locate the root TOC.
@@ -2050,15 +2671,12 @@ def commit_updated_document_to_database(app):
                 # fall in the document structure.  For example, we have RST
                 # files, but they were not included in any toctree, yet they
                 # were compiled by Sphinx.
-                prev_link, _ = models.Link.objects.get_or_create(
-                    link = u'../',
-                    title = u'')
+                prev_link = get_link(u'../', u'')
 
             # While we are here, create a "root TOC" link with the appropriate
             # title: use the ``project`` setting from the Sphinx conf.py file.
             # The actual link will be determined on page request.
-            models.Link.objects.get_or_create(link = '___TOC___',
-                                              title = app.env.config.project)
+            get_link('___TOC___', app.env.config.project)
 
         # Generate a "local" table of contents: useful for long pages; will not
         # be generated if there is only one subsection on the page, nor will
@@ -2067,7 +2685,7 @@ def commit_updated_document_to_database(app):
             # Good side-effect: TOC pages will never show up in search results
             local_toc = ''
         else:
-            local_toc = page_info['toc']
+            local_toc = record.toc
             local_toc, number = local_toc_re.subn(replace_toc, local_toc)
             if number == 1:
                 local_toc = ''
@@ -2077,207 +2695,418 @@ def commit_updated_document_to_database(app):
 
         # Use the Project's name for the master_doc (i.e. the main TOC page)
         # for the document.
+        title = record.title
         if is_toc and not(is_chapter_index):
-            page_info['title'] = app.env.config.project
+            title = app.env.config.project
+
+        fields = {'content_hash': record.content_hash,
+                  'html_title': title,
+                  'is_toc': is_toc or is_chapter_index,
+                  'source_name': record.source_name,
+                  'PDF_file_name': 'STILL_TO_COME.pdf',
+                  'body': '\n' + record.body + '\n',
+                  'parent_link': parent_link,
+                  'next_link': next_link,
+                  'prev_link': prev_link,
+                  'local_toc': local_toc,}
 
         # If a page with the same link (an unique field) is found, then update
         # the page.  Do not delete the page, because that will remove any
         # associated comments.  See the ``models.py`` file for ``Comment``
         # definition -- the ``Page`` objects are a ForeignKey.
-
-        existing_page = prior_pages.filter(link_name=link_name)
-        if existing_page:
-            page = existing_page[0]
-            if page.search_text.encode('utf-8') != search_text:
+        if page:
+            # Only write the fields that have changed
+            changed = {}
+            for field, value in fields.iteritems():
+                if field.endswith('_link'):
+                    # Compare the ForeignKeys' id, to avoid a query for each
+                    if getattr(page, field + '_id') == (value and value.pk):
+                        continue
+                elif getattr(page, field) == value:
+                    continue
+                changed[field] = value
+
+            page_search = prior_search.get(page.pk)
+            if page_search is None:
+                page_search = models.PageSearchText(page=page)
+            if page_search.get_text().encode('utf-8') != search_text:
                 # If the content has changed, only then change ``updated_on``
-                page.updated_on = datetime.datetime.now()
-            if is_toc or is_chapter_index:
-                if page.body != '\n' + page_info['body'] + '\n':
-                    page.updated_on = datetime.datetime.now()
-
-            page.revision_changeset = sphinx_settings['revision_changeset']
-            page.html_title = page_info['title']
-            page.is_toc = is_toc or is_chapter_index
-            page.source_name = unsplit_source_name
-            page.PDF_file_name = 'STILL_TO_COME.pdf'
-            page.body = '\n' + page_info['body'] + '\n'
-            page.search_text = search_text
-            page.parent_link = parent_link
-            page.next_link = next_link
-            page.prev_link = prev_link
-            page.local_toc = local_toc
-            page.save()
+                changed['updated_on'] = datetime.datetime.now()
+                page_search.set_text(search_text)
+                if page_search.pk:
+                    page_search.save()
+                else:
+                    new_search.append(page_search)
+            if (is_toc or is_chapter_index) and 'body' in changed:
+                changed['updated_on'] = datetime.datetime.now()
+
+            if changed:
+                models.Page.objects.filter(pk=page.pk).update(**changed)
+                n_changed += 1
         else:
-            defaults = {'revision_changeset': \
+            fields.update({'revision_changeset': \
                                         sphinx_settings['revision_changeset'],
-                        'link_name': link_name,
-                        'html_title': page_info['title'],
-                        'is_toc': is_toc or is_chapter_index,
-                        'source_name': unsplit_source_name,
-                        'PDF_file_name': 'STILL_TO_COME.pdf',
-                        'number_of_HTML_visits': 0,
-                        'body': '\n' + page_info['body'] + '\n',
-                        'search_text': search_text,
-                        'parent_link': parent_link,
-                        'next_link': next_link,
-                        'prev_link': prev_link,
-                        'local_toc': local_toc,}
-            created = models.Page.objects.create(**defaults)
-
-        file_linkname_map[app.srcdir + os.sep + fname + \
-                                     app.env.config.source_suffix] = link_name
-
-    log_file.info('PUBLISH: pages saved to the database.')
+                           'link_name': link_name,
+                           'number_of_HTML_visits': 0,})
+            page = models.Page.objects.create(**fields)
+            prior_pages[link_name] = page
+            page_search = models.PageSearchText(page=page)
+            page_search.set_text(search_text)
+            new_search.append(page_search)
+
+        published_pages.append(page.pk)
+
+    bulk_insert(models.PageSearchText, new_search)
+
+    # The revision is the same for every published page: a query per chunk
+    for pks in chunked(published_pages):
+        models.Page.objects.filter(pk__in=pks).update(
+                        revision_changeset=sphinx_settings['revision_changeset'])
+
+    log_file.info(('PUBLISH: pages saved to the database; %d of %d pages had '
+                   'changes.') % (n_changed, len(published_pages)))
+    timer.lap('database: pages')
+    timer.counts['pages'] = len(published_pages)
+    timer.counts['pages changed'] = n_changed
+    set_publish_progress(job_id, phase='saving comment references',
+                         pages_processed=len(ordered_names))
 
     # Next, deal with the comment references
     # ---------------------------------------------
-    to_update = []
-    to_remove = []
-    orphans = []
-    prior_references = models.CommentReference.objects.all()
-
-    # Only if we used a fresh environment.  Because then all the comment
-    # references are regenerated.
-    if conf.use_freshenv:
-        for item in prior_references:
-            orphans.append(item.comment_root)
-
-    for item in sphinx_settings['comment_refs']:
-        # First check whether this comment reference exists in the database;
-        # If not, add it.  If it does exist, add it to the list of references
-        # to update next.
-        defaults={'revision_changeset': sphinx_settings['revision_changeset'],
-                  'file_name': item.source,
-                  'page_link_name': file_linkname_map[item.link_name],
-                  'node_type': item.node,
-                  'line_number': item.line,
-                  'comment_root': item.root,
-                  'comment_root_is_used': False}
-        ref, created = models.CommentReference.objects.get_or_create(
-            comment_root=item.root,  # comment_root is a unique field
-            defaults=defaults)
-        if not created:
-            try:
-                orphans.remove(item.root)
-            except ValueError:
-                pass
-            to_update.append(item)
+    counts = commit_comment_references(sphinx_settings['comment_refs'],
+                                       file_linkname_map,
+                                       sphinx_settings['revision_changeset'],
+                                       prior_pages, conf.use_freshenv, timer)
+    for name, number in counts.iteritems():
+        timer.counts['comment references ' + name] = number
+
+    # If the transaction is rolled back, the saved content hashes no longer
+    # match the database, so these pages are loaded again next time.
+    mediasync.save_manifest(app.doctreedir, new_summaries, PAGE_SUMMARY_NAME)
+    return len(published_pages)
+
+def commit_comment_references(comment_refs, file_linkname_map,
+                              revision_changeset, pages, use_freshenv=False,
+                              timer=None):
+    """
+    Reconciles the ``comment_refs`` found while compiling the document with
+    the comment references in the database:
+
+    * new comment roots are added
+    * existing roots are updated, writing only the fields that have changed
+    * if a fresh environment was used (``use_freshenv``), then all the comment
+      references were regenerated, so any prior root that was not found again
+      is stale: it is removed if it has no comments, otherwise it is an orphan
+      and its comments are moved to the unreachable "_orphans_" page.
+
+    The roots are compared as sets, so this takes a handful of queries, rather
+    than several queries per comment reference.  ``pages`` is a dictionary of
+    ``link_name -> Page`` for the published pages.
+
+    Returns a dictionary with the number of "new", "updated", "moved",
+    "removed" and "orphaned" references.
+    """
+    # Only load the fields that are compared, rather than complete objects
+    prior = {}
+    for pk, root, file_name, node_type, line_number, revision in \
+                    models.CommentReference.objects.values_list('pk',
+                    'comment_root', 'file_name', 'node_type', 'line_number',
+                    'revision_changeset'):
+        prior[root] = (pk, file_name, node_type, line_number, revision)
+
+    current = {}
+    for item in comment_refs:
+        current[item.root] = item
+
+    prior_roots = set(prior)
+    current_roots = set(current)
+    new_roots = current_roots - prior_roots
+    existing_roots = current_roots & prior_roots
+    if use_freshenv:
+        stale_roots = prior_roots - current_roots
+    else:
+        stale_roots = set()
+
+    # The (very unusual) case of existing comments, but no reference in the DB,
+    # is when the RST repo is processed the first time and there happen to be
+    # ucomment directives in the RST source.
+    new_references = []
+    for root in new_roots:
+        item = current[root]
+        new_references.append(models.CommentReference(
+                    revision_changeset=revision_changeset,
+                    file_name=item.source,
+                    page_link_name=file_linkname_map[item.link_name],
+                    node_type=item.node,
+                    line_number=item.line,
+                    comment_root=root,   # comment_root is a unique field
+                    comment_root_is_used=False))
+    bulk_insert(models.CommentReference, new_references)
 
     # Update the references that already exist in the DB.  In most cases these
     # references are used as ForeignKeys in ``Comment`` objects.
-    # The (very unusual) case when they don't exist in the DB is when the RST
-    # repo is processed the first time and there happen to be ucomment
-    # directives in the RST source.  In this case we would have created a
-    # comment reference in the code above (using ``get_or_create()``)
-
-    for item in to_update:
-        ref = prior_references.filter(comment_root=item.root)[0]
-        ref.revision_changeset = sphinx_settings['revision_changeset']
-        ref.file_name = item.source
-        ref.node_type = item.node
-        ref.line_number = item.line
-        ref.date_added = datetime.datetime.now()
-        ref.save()
-        # The above code is quite useful: if the author ever happens to move the
-        # ucomment directives around, even to a different file, the comments
-        # associated with that reference will still appear at the new location.
-
-    # Orphans occur if the user removed the ucomment directive from the RST
-    # source.
-    # They are problematic only if they happen to have an associated ``Comment``
-    # object in the database (which is expected, since a CommentReference is
-    # created the same time ).
-    for item in orphans[:]:
-        # Remove comment references from the list that don't have comments.
-        ref = prior_references.filter(comment_root=item)[0]
-        if ref.comment_set.exists() == False:
-            orphans.remove(item)
-            to_remove.append(item)
-
-    # It is safe to remove these references, because they do not have any
-    # comments associated with them (CommentReference objects only appear as
+    # The fields that are the same for every reference: a query per chunk
+    for pks in chunked([prior[root][0] for root in existing_roots]):
+        models.CommentReference.objects.filter(pk__in=pks).update(
+                                        revision_changeset=revision_changeset,
+                                        date_added=datetime.datetime.now())
+
+    # The fields that differ: only write the references that have moved.  This
+    # is quite useful: if the author ever happens to move the ucomment
+    # directives around, even to a different file, the comments associated
+    # with that reference will still appear at the new location.
+    n_moved = 0
+    for root in existing_roots:
+        pk, file_name, node_type, line_number, _ = prior[root]
+        item = current[root]
+        changed = {}
+        if file_name != item.source:
+            changed['file_name'] = item.source
+        if node_type != item.node:
+            changed['node_type'] = item.node
+        if line_number != item.line:
+            changed['line_number'] = item.line
+        if changed:
+            models.CommentReference.objects.filter(pk=pk).update(**changed)
+            n_moved += 1
+
+    if timer:
+        timer.lap('database: comment references')
+
+    # Stale references are problematic only if they happen to have associated
+    # ``Comment`` objects in the database: those are orphans.  It is safe to
+    # remove the others, because CommentReference objects only appear as
     # ForeignKeys in ``Comment`` objects.
-    for remove_root in to_remove:
-        to_remove = prior_references.filter(comment_root=remove_root)
-        if to_remove:
-            to_remove[0].delete()
-
-    for orphan_id in orphans:
-        # These arise when comment references are removed from the text by the
-        # author.  But, these references still have comments associated with
-        # them in the database, but are not made available on any page,
-        # nor do they have a valid comment reference.
-
-        orphan = prior_references.filter(comment_root = orphan_id)[0]
-
-        # Create an unreachable page (starts with '_')
-        defaults = {'revision_changeset': sphinx_settings['revision_changeset'],
-                    'link_name': '_orphans_',
-                    'html_title': '_orphans_',
-                    'is_toc': False,
-                    'source_name': '_orphans_',
-                    'PDF_file_name': '_orphans_',
-                    'number_of_HTML_visits': 0,
-                    'body': '_orphans_',
-                    'search_text': '',
-                    'parent_link': None,
-                    'next_link': None,
-                    'prev_link': None,
-                    'local_toc': '',}
-        orphan_page, created = models.Page.objects.get_or_create(
-                                                        link_name='_orphans_',
-                                                        defaults=defaults)
-        # Create an comment reference that would not normally be created
-        defaults = {'revision_changeset': '-1',
-                    'file_name': '_orphans_',
-                    'node_type': '_orphan_',
-                    'line_number': 0,
-                    'comment_root': '_ORFN_',
-                    'comment_root_is_used': True}
-        orphan_ref, created = models.CommentReference.objects.get_or_create(
-                                                        comment_root='_ORFN_',
-                                                        defaults=defaults)
-
-        # Try to de-orphan any comments on subsequent republishing (author may
-        # have realized the mistake and brought the node back).
-        if orphan_id == '_ORFN_':
-
-            # It's a little hard to go back from the orphaned comment to find
-            # its original reference.  But we will use the fact the re-created
-            # reference's comment_root will be the same as the orphaned
-            # comment's parent (or at least the first ``conf.root_node_length``
-            # characters of the parent).
-            for comment in orphan.comment_set.all():
-                former_parent = comment.parent[0:conf.root_node_length]
-                new_parent = prior_references.filter(comment_root=former_parent)
-                if len(new_parent):
-                    comment.reference = new_parent[0]
-
-                    # Now find the page on which that comment reference is used
-                    all_pages = models.Page.objects.filter(
-                                        link_name=new_parent[0].page_link_name)
-                    if len(all_pages):
-                        comment.page = all_pages[0]
-
-                    comment.save()
-
-                    log_file.warn(('PUBLISH: re-parented the orphan comment '
-                                   'reference %s; now appears on page "%s".')%\
-                                    (comment.reference.comment_root,
-                                     new_parent[0].page_link_name))
-
-        n_orphans = 0
-        for comment in orphan.comment_set.all():
-            comment.reference = orphan_ref
-            comment.page = orphan_page
-            comment.save()
-            n_orphans += 1
-
-            log_file.warn(('PUBLISH: dealt with comment reference orphan: %s; '
-                           'was orphaned between revision %s (last known use) '
-                           'and revision %s (current).  Has %d associated '
-                           'comments.') % (orphan_id, orphan.revision_changeset,
-                           sphinx_settings['revision_changeset'], n_orphans))
+    stale = dict((prior[root][0], root) for root in stale_roots)
+    with_comments = set()
+    for pks in chunked(stale):
+        with_comments.update(models.Comment.objects.filter(
+                    reference__in=pks).values_list('reference', flat=True))
+    removable = set(stale) - with_comments
+    for pks in chunked(removable):
+        models.CommentReference.objects.filter(pk__in=pks).delete()
+
+    if with_comments:
+        commit_orphaned_comments(dict((pk, stale[pk]) for pk in with_comments),
+                                 prior, revision_changeset, pages)
+    if timer:
+        timer.lap('database: orphans')
+
+    counts = {'new': len(new_roots), 'updated': len(existing_roots),
+              'moved': n_moved, 'removed': len(removable),
+              'orphaned': len(with_comments)}
+    log_file.info(('PUBLISH: comment references: %(new)d new; %(updated)d '
+                   'updated (%(moved)d moved); %(removed)d removed; '
+                   '%(orphaned)d orphaned.') % counts)
+    return counts
+
+def commit_orphaned_comments(orphans, prior, revision_changeset, pages):
+    """
+    Orphans arise when comment references are removed from the text by the
+    author.  But, these references still have comments associated with
+    them in the database, but are not made available on any page,
+    nor do they have a valid comment reference.  Their comments are moved to
+    an unreachable page (starts with '_') and reference.
+
+    ``orphans`` is a dictionary of ``pk -> comment_root`` for the orphaned
+    references, while ``prior`` has the previous information for each root.
+    """
+    # Create an unreachable page (starts with '_')
+    defaults = {'revision_changeset': revision_changeset,
+                'link_name': '_orphans_',
+                'html_title': '_orphans_',
+                'is_toc': False,
+                'source_name': '_orphans_',
+                'PDF_file_name': '_orphans_',
+                'number_of_HTML_visits': 0,
+                'body': '_orphans_',
+                'parent_link': None,
+                'next_link': None,
+                'prev_link': None,
+                'local_toc': '',}
+    orphan_page, created = models.Page.objects.get_or_create(
+                                                    link_name='_orphans_',
+                                                    defaults=defaults)
+    # Create an comment reference that would not normally be created
+    defaults = {'revision_changeset': '-1',
+                'file_name': '_orphans_',
+                'node_type': '_orphan_',
+                'line_number': 0,
+                'comment_root': '_ORFN_',
+                'comment_root_is_used': True}
+    orphan_ref, created = models.CommentReference.objects.get_or_create(
+                                                    comment_root='_ORFN_',
+                                                    defaults=defaults)
+
+    # Try to de-orphan any comments on subsequent republishing (author may
+    # have realized the mistake and brought the node back).
+    # It's a little hard to go back from the orphaned comment to find
+    # its original reference.  But we will use the fact the re-created
+    # reference's comment_root will be the same as the orphaned
+    # comment's parent (or at least the first ``conf.root_node_length``
+    # characters of the parent).
+    if orphan_ref.pk in orphans:
+        former_parents = defaultdict(list)
+        for pk, parent in models.Comment.objects.filter(
+                        reference=orphan_ref).values_list('pk', 'parent'):
+            former_parents[parent[0:conf.root_node_length]].append(pk)
+
+        for roots in chunked(former_parents):
+            for ref_pk, root, page_link_name in \
+                        models.CommentReference.objects.filter(
+                        comment_root__in=roots).exclude(pk=orphan_ref.pk)\
+                        .values_list('pk', 'comment_root', 'page_link_name'):
+                changed = {'reference': models.CommentReference(pk=ref_pk)}
+                # Now find the page on which that comment reference is used
+                if page_link_name in pages:
+                    changed['page'] = pages[page_link_name]
+                models.Comment.objects.filter(pk__in=former_parents[root])\
+                                                            .update(**changed)
+                log_file.warn(('PUBLISH: re-parented %d orphan comment(s) to '
+                               'reference %s; now appears on page "%s".') % \
+                              (len(former_parents[root]), root, page_link_name))
+
+    # Move all the comments for the other orphans in one go
+    n_orphans = defaultdict(int)
+    others = [pk for pk in orphans if pk != orphan_ref.pk]
+    for pks in chunked(others):
+        for pk in models.Comment.objects.filter(reference__in=pks)\
+                                    .values_list('reference', flat=True):
+            n_orphans[pk] += 1
+        models.Comment.objects.filter(reference__in=pks).update(
+                                        reference=orphan_ref, page=orphan_page)
+
+    for pk, number in n_orphans.iteritems():
+        root = orphans[pk]
+        log_file.warn(('PUBLISH: dealt with comment reference orphan: %s; '
+                       'was orphaned between revision %s (last known use) '
+                       'and revision %s (current).  Has %d associated '
+                       'comments.') % (root, prior[root][4], revision_changeset,
+                                       number))
+
+# Removing unused comment references
+# ----------------------------------
+HTML_ID_RE = re.compile(r'\sid="([^"]+)"')
+
+def comment_reference_table_size():
+    """
+    Returns the space used by the comment reference table (and its indices)
+    in bytes, or ``None`` if the database cannot report it.
+    """
+    engine = connection.settings_dict.get('ENGINE', '')
+    if 'postgresql' not in engine:
+        return None
+    cursor = connection.cursor()
+    cursor.execute('SELECT pg_total_relation_size(%s)',
+                   [models.CommentReference._meta.db_table])
+    return cursor.fetchone()[0]
+
+def collect_unused_references(retention_days=None, batch_size=None,
+                              dry_run=False):
+    """
+    Deletes comment references that were never used: ``comment_root_is_used``
+    is False, no comment points to them, their root does not appear on any
+    published page, and they were last published more than ``retention_days``
+    ago.  References are deleted ``batch_size`` at a time, each batch in its
+    own transaction, so the table is not locked for long.
+
+    Returns a dictionary with the number of references ``before`` and
+    ``after``, the number ``removed`` and the table size (bytes; ``None`` if
+    unknown) ``size_before`` and ``size_after``.  Nothing is deleted if
+    ``dry_run`` is True, but ``removed`` is still reported.
+    """
+    if retention_days is None:
+        retention_days = conf.reference_retention_days
+    if batch_size is None:
+        batch_size = conf.reference_gc_batch_size
+    references = models.CommentReference.objects
+    report = {'before': references.count(),
+              'size_before': comment_reference_table_size()}
+
+    # Roots that appear in the latest publish of each page.  The extension
+    # writes every comment root as the ``id`` of its node.
+    live_roots = set()
+    for body in models.Page.objects.values_list('body', flat=True).iterator():
+        live_roots.update(HTML_ID_RE.findall(body))
+
+    # Never delete a reference that has comments: they would be deleted too.
+    with_comments = set(models.Comment.objects.values_list('reference',
+                                                         flat=True).distinct())
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=retention_days)
+    unused = [pk for pk, root in references.filter(comment_root_is_used=False,
+                                date_added__lt=cutoff).values_list('pk',
+                                                            'comment_root')
+              if root not in live_roots and pk not in with_comments]
+
+    report['removed'] = len(unused)
+    if not dry_run:
+        for pks in chunked(unused, batch_size):
+            references.filter(pk__in=pks).delete()
+
+    report['after'] = references.count()
+    report['size_after'] = comment_reference_table_size()
+    log_file.info(('GC: %(removed)d unused comment references removed; '
+                   '%(before)d before and %(after)d after.') % report)
+    return report
+
+def rebuild_search_text(dry_run=False):
+    """
+    Fills in the ``PageSearchText`` for published pages that have none, from
+    the ``search_text`` column of the page table used by earlier versions of
+    this application (if the column is still there).  Search text that is not
+    stored as ``conf.compress_search_text`` requires, is (de)compressed.
+
+    Upgrading from a version with the ``search_text`` column is done in this
+    order: deploy this version and run ``syncdb`` (to create the new table),
+    run this function (``manage.py rebuild_search_text``), and only then drop
+    the old column.  New pages cannot be published while the old column is
+    still there, since it does not allow NULL values.
+
+    Returns a dictionary with the number of search texts ``created`` and
+    ``converted``, the number of pages still ``missing`` their search text
+    (these are only filled in by republishing every page), and whether the
+    ``old_column`` is still in the page table.  Nothing is saved if
+    ``dry_run`` is True, but the numbers are still reported.
+    """
+    report = {'created': 0, 'converted': 0, 'missing': 0}
+    for page_search in models.PageSearchText.objects.exclude(
+                is_compressed=conf.compress_search_text).iterator():
+        report['converted'] += 1
+        if not dry_run:
+            page_search.set_text(page_search.get_text())
+            page_search.save()
+
+    pages = set(models.Page.objects.exclude(link_name='_orphans_').filter(
+                        search__isnull=True).values_list('pk', flat=True))
+    old_texts = {}
+    table = models.Page._meta.db_table
+    cursor = connection.cursor()
+    columns = [column[0] for column in \
+               connection.introspection.get_table_description(cursor, table)]
+    report['old_column'] = 'search_text' in columns
+    if pages and report['old_column']:
+        for pks in chunked(sorted(pages)):
+            cursor.execute('SELECT id, search_text FROM %s WHERE id IN (%s)' % \
+                           (connection.ops.quote_name(table),
+                            ', '.join(['%s'] * len(pks))), pks)
+            old_texts.update(cursor.fetchall())
+
+    new_search = []
+    for pk in pages:
+        if pk not in old_texts:
+            report['missing'] += 1
+            continue
+        page_search = models.PageSearchText(page_id=pk)
+        page_search.set_text(old_texts[pk] or '')
+        new_search.append(page_search)
+    report['created'] = len(new_search)
+    if not dry_run:
+        bulk_insert(models.PageSearchText, new_search)
+
+    log_file.info(('SEARCH: %(created)d search texts created, %(converted)d '
+                   'converted; %(missing)d pages have no search text.') % \
+                   report)
+    return report
 
 # Dumping and loading fixtures
 # ----------------------------
@@ -2324,198 +3153,250 @@ def load_from_fixtures(request):
 
 # Searching the document text
 # ---------------------------
+# The regular expressions used to clean the RST source are compiled once, when
+# this module is loaded, since ``sanitize_search_text`` is called for every
+# page that is published.
+
+# Directives and other explicit markup that start with ".. ".
+SEARCH_MARKUP_RE = re.compile(r"""^\s*\.\.\ (?:
+                                   (?P<ucomment>ucomment::\s*.*?:)|
+                                   (?P<crossref>_.*?:)|
+                                   (?P<image>(?:figure|image)::)|
+                                   (?P<rubric>rubric::\ ))""", re.X)
+
+# Underlines (and overlines) for headings: e.g. "-----".  Any of the valid
+# RST title characters, repeated 3 or more times, and nothing else.
+SEARCH_DIVIDER_RE = re.compile(r'^([!-/:-@\[-`{-~])\1{2,}\s*$')
+
+# Table borders: "=====  ====" for simple tables and "+----+----+" or
+# "+====+====+" for grid tables.
+SEARCH_TABLE_BORDER_RE = re.compile(r'^\s*(?:[=-]{2,}(?: +[=-]{2,})*|'
+                                    r'\+(?:[-=]{2,}\+)+)\s*$')
+
+# The rows of grid tables: "| cell | cell |"
+SEARCH_TABLE_ROW_RE = re.compile(r'^\s*\|.*\|\s*$')
+
+# The options that go with a figure or image directive, e.g. ":scale: 50"
+SEARCH_OPTION_RE = re.compile(r'^\s+:[\w-]+:')
+
+# Inline math roles :math:`....`
+SEARCH_MATH_ROLE_RE = re.compile(r':math:`(.*?)`')
+
+# Lines starting with any of these characters (after whitespace) might be one
+# of the above; all other lines are left as they are.
+SEARCH_SPECIAL_START = frozenset('!"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~')
+
 def sanitize_search_text(text):
     """
     Cleans the RST source code to remove:
 
     * .. ucomment:: directives
     * Underlines for headings: e.g. "-----"
-    * inline math roles :math:`....` (leaves the part inside the role beind
+    * inline math roles :math:`....` (leaves the part inside the role behind)
     * cross-references: e.g.  .. _my-cross-reference:
     * .. rubric:: XYZ is left just as XYZ
+    * table borders, and the "|" column separators in grid table rows
+    * figure and image directives; and the options that go with them (the
+      figure's caption is kept)
 
-    TODO(KGD):
-    * table_row = re.compile(r'(={2,})|(\+-{2,})')
-    * figure and image directives; and the options that go with them
-
+    The text is processed in a single pass, line by line.
     """
-    text_list = text.split('\n')
-    ucomment_lines = re.compile(r'^\s*\.\. ucomment::\s*(.*?):')
-    VALID_TITLES = ['!', '"', '#', '$', '%', "'", '(', ')', '*', '+',
-                    ',', '-', '.', '/', ':', ';', '<', '=', '>', '?',
-                    '@', '[', '\\', ']', '^', '_', '`', r'{', '|',
-                    '}', '~']
+    out = []
+    in_options = False
+    for line in text.split('\n'):
+        stripped = line.lstrip()
+        if in_options:
+            # Skip the options that follow a figure or image directive
+            if stripped and SEARCH_OPTION_RE.match(line):
+                continue
+            in_options = False
+
+        if stripped and stripped[0] in SEARCH_SPECIAL_START:
+            if stripped.startswith('.. '):
+                markup = SEARCH_MARKUP_RE.match(line)
+                if markup:
+                    if markup.group('rubric'):
+                        line = line[markup.end():]
+                    else:
+                        in_options = bool(markup.group('image'))
+                        continue
+            elif SEARCH_DIVIDER_RE.match(line) or \
+                                        SEARCH_TABLE_BORDER_RE.match(line):
+                continue
+            elif stripped[0] == '|' and SEARCH_TABLE_ROW_RE.match(line):
+                line = line.replace('|', ' ')
+
+        if ':math:`' in line:
+            line = SEARCH_MATH_ROLE_RE.sub(r'\1', line)
+        out.append(line)
 
-    div_re_str = r'^'
-    for entry in VALID_TITLES:
-        if entry in ['^', '*', '+', '$', '(', ')', '-', '.', '?', '[', ']',
-                      '\\', '{', '}', '|']:
-            entry = '\\' + entry
+    return '\n'.join(out)
 
-        div_re_str += entry + r'{3,}|'
-    div_re_str = div_re_str[0:-1] + '$'
-    div_re = re.compile(div_re_str)
 
-    crossref_re = re.compile(r'^\s*\.\. _(.*?):')
-    rubric_re = re.compile(r'^\s*(\.\. rubric:: )(.*?)')
+def compile_search_regex(search_words, with_case):
+    """
+    Compiles a single regular expression that matches any one of the
+    ``search_words`` as a whole word.  Compile it once per query and reuse it
+    for every page; longer words are tried first so that they win over any
+    shorter word they may contain.
 
-    # Remove the :math:`...` part, leaving only the ... portion behind.
-    math_role = re.compile(r'(:math:`)(.*?)(`)')
+    The ``with_case`` input will either ``True`` (case-sensitive), or ``False``.
+    """
+    words = sorted(set(search_words), key=len, reverse=True)
+    pattern = r'\b(%s)\b' % '|'.join([re.escape(word) for word in words])
+    # Whole words only, where the definition is locale (re.L) and unicode
+    # (re.U) dependent.
+    if with_case:
+        return re.compile(pattern, re.L + re.U)
+    else:
+        return re.compile(pattern, re.I + re.L + re.U)
 
-    out = []
-    for line in text_list:
-        line = math_role.sub('\g<2>', line)
-        line = rubric_re.sub('\g<2>', line)
-        out.append(line)
-        if ucomment_lines.match(line):
-            out.pop()
-            continue
-        if div_re.match(line):
-            out.pop()
-            continue
-        if crossref_re.match(line):
-            out.pop()
-            continue
+def merge_spans(spans):
+    """
+    Takes a list of ``(start, end)`` tuples and returns a sorted list of
+    non-overlapping spans, where any spans that overlap (or touch) are merged
+    into one.  A single pass over the sorted spans.
 
-    return '\n'.join(out)
+    >>> merge_spans([(10, 20), (0, 5), (15, 30), (30, 32)])
+    [(0, 5), (10, 32)]
+    """
+    merged = []
+    for start, end in sorted(spans):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
 
+def highlight_search_terms(text, start, end, search_re):
+    """
+    Returns the ``text[start:end]`` portion, cleaned for display in a browser,
+    with every match of ``search_re`` wrapped inside ``<span>`` brackets.
 
-def format_search_pages_for_web(pages, context, with_case):
+    The matching is done on the raw text, and only the pieces in between are
+    escaped, so the search terms can never match inside HTML entities such as
+    ``&amp;`` that escaping would introduce.  Newlines are replaced by spaces.
     """
-    Receives a dictionary.  The keys are ``Page`` objects, and the corresponding
-    values are the list of words that appear on that page.
+    out = []
+    last = start
+    for reobj in search_re.finditer(text, start, end):
+        out.append(django_html.escape(text[last:reobj.start()]))
+        out.append('<span id="ucomment-search-term">%s</span>' % \
+                                        django_html.escape(reobj.group()))
+        last = reobj.end()
+    out.append(django_html.escape(text[last:end]))
+    return ''.join(out).replace('\n', ' ')
+
+def search_snippet(page_text, search_re, context, with_case, n_instances=3):
+    """
+    Finds the matches of ``search_re`` in the ``page_text`` in one pass.
+
+    Returns a tuple: the number of matches, and the HTML snippet to display.
+    The snippet contains ``context`` number of characters around the first
+    ``n_instances`` appearances of every search word, where the overlapping
+    regions are merged together.
+    """
+    maxlen = len(page_text)
+    all_spans = []
+    word_counts = defaultdict(int)
+    n_hits = 0
+    for reobj in search_re.finditer(page_text):
+        n_hits += 1
+        word = reobj.group()
+        if not with_case:
+            word = word.lower()
+        word_counts[word] += 1
+        if word_counts[word] > n_instances:
+            continue
+        all_spans.append((max(0, reobj.start()-context),
+                          min(maxlen, reobj.end()+context)))
 
-    Will format these into appropriate HTML string output that is sent to the
-    user.
+    if n_hits == 0:
+        return 0, ''
 
-    Uses ``context`` number of characters around the search word to display
-    in the results.
+    # Extract the text within each range, and highlight it
+    startend = '...'
+    display = [startend]
+    for start, end in merge_spans(all_spans):
+        display.append(highlight_search_terms(page_text, start, end,
+                                              search_re))
+        display.append(startend)
+    return n_hits, ''.join(display)
 
-    The ``with_case`` input will either ``True`` (indicating case-sensitive
-    search was requested), or ``False``.
+def count_search_hits(page_text, search_re):
     """
-    def common_span(spanA, spanB):
-        """
-        Takes two tuples (containing 2 integers) and returns the largest region
-        spanned, provided they overlap.  If no overlap, then return two spans
-        exactly as they were received.
-
-        Can be improved later on to avoid really large spans by taking
-        some sort of compromised span.
-        """
-        # First sort them
-        swapped = False
-        if spanA[0] > spanB[0]:
-            spanA, spanB = spanB, spanA
-            swapped = True
-        # If they overlap, return the intersection of the spans
-        if spanA[1] > spanB[0]:
-            return ((spanA[0], max(spanA[1], spanB[1])), )
-        elif swapped:
-            return (spanB, spanA)
-        else:
-            return (spanA, spanB)
+    Returns the number of matches of ``search_re`` in the ``page_text``.
+    """
+    return sum(1 for _ in search_re.finditer(page_text))
 
-    def clean_search_output_for_web(text):
-        """
-        Returns a cleaned version of ``text`` suitable for display in a browser.
-        * Removes newline markers
-        * Converts the string to web-safe output
-        """
-        text = re.sub('\n', ' ', text)
-        #text = html.strip_tags(text)
-        text = django_html.escape(text)
-        # replace('&', '&amp;')
-        #.replace('<', '&lt;')
-        #.replace('>', '&gt;')
-        #.replace('"', '&quot;')
-        #.replace("'", '&#39;'))
-        return text
-
-
-    results = defaultdict(list)
-    page_counts = {}
-    n_pages = 0
-    for page, search_words in pages.iteritems():
-        # For each word, find the first N (use N=3) appearances in the text.
-        # Get the context to the left and right of the word, store the ranges
-        # in a list.
-        page_text = page.search_text
-        maxlen = len(page_text)
-        N_instances = 3
-        all_spans = []
-        page_counts[page] = 0
-        for word in search_words:
-            # Find these words, ensuring they are whole words only, where the
-            # definition is locale (re.L) and unicode (re.U) dependent.
-            if with_case:
-                word_iter = re.finditer(r'\b' + word + r'\b', page_text,
-                                        re.L + re.U)
-            else:
-                word_iter = re.finditer(r'\b' + word + r'\b' , page_text,
-                                        re.I + re.L + re.U)
-            for idx, reobj in enumerate(word_iter):
-                if idx >= N_instances:
-                    # How many entries were there ?
-                    page_counts[page] += len(list(word_iter)) + 1
-                    break
-                span = reobj.span()
-                span = (max(0, span[0]-context), min(maxlen, span[1]+context))
-                all_spans.append(span)
-                page_counts[page] += 1
+def rank_search_pages(pages, search_re, offset=0, limit=None):
+    """
+    Ranks the ``pages`` (any iterable of ``Page`` objects) by the number of
+    search hits on each page: a crude relevance metric.
 
+    Returns a tuple: the total number of pages with at least one hit, and a
+    list of ``(n_hits, page)`` tuples for only the pages in the requested
+    result page (from ``offset``, at most ``limit`` entries), ordered from high
+    to low.  A heap is used to select the top entries, so that the pages
+    outside the requested result page are never sorted.
+    """
+    ranked = []
+    for page in pages:
+        n_hits = count_search_hits(page.search_text, search_re)
         # We don't always find the text (i.e. a false result) when using sqlite
         # databases and requesting a case-sensitive search. Just skip over these
         # pages.
-        if len(all_spans) == 0:
-            continue
+        if n_hits:
+            ranked.append((n_hits, page))
 
-        # Now combine all the ranges together, consolidating overlapping regions
-        final_spans = {all_spans[0]: None}  # Use a dict to ensure unique spans
-        for span in all_spans[1:]:
-            keys = final_spans.keys()
-            for key in keys:
-                overlap = common_span(key, span)
-                if len(overlap) == 1:
-                    del final_spans[key]
-                    final_spans[overlap[0]] = None
-                else:
-                    final_spans[overlap[1]] = None
+    if limit is None:
+        top = sorted(ranked, key=lambda item: item[0], reverse=True)
+    else:
+        top = heapq.nlargest(offset+limit, ranked, key=lambda item: item[0])
+    return len(ranked), top[offset:]
 
-        # Extract the text within the range
-        display = ''
-        startend = '...'
-        for span in sorted(final_spans.keys()):
-            display += startend + page_text[span[0]:span[1]]
-        display += startend
+def search_and_rank_pages(pages, with_case, offset=0, limit=None):
+    """
+    Ranks the ``pages`` found by ``find_search_pages``: a dictionary of pages
+    and the search words found on each page.
 
-        # Clean-up the text for web rendering
-        display = clean_search_output_for_web(display)
+    Returns the total number of matching pages, the ranked ``(hits, page)``
+    tuples from ``offset`` onwards (at most ``limit`` of them), and the
+    compiled search regular expression (None if there were no words).
+    """
+    all_words = set()
+    for search_words in pages.itervalues():
+        all_words.update(search_words)
+    if not all_words:
+        return 0, [], None
+    search_re = compile_search_regex(all_words, with_case)
+    n_pages, top = rank_search_pages(pages.iterkeys(), search_re, offset,
+                                     limit)
+    return n_pages, top, search_re
 
-        # Finally, highlight the search terms inside ``<span>`` brackets
-        for word in search_words:
-            if with_case:
-                word_re = re.compile(r'(%s)'%word)
-            else:
-                word_re = re.compile(r'(%s)'%word, re.I)
-            display = word_re.sub(\
-                          r'<span id="ucomment-search-term">\1</span>', display)
+def format_search_pages_for_web(pages, context, with_case, offset=0,
+                                limit=None, base_url=''):
+    """
+    Receives a dictionary.  The keys are ``Page`` objects, and the corresponding
+    values are the list of words that appear on that page.
 
+    Will format these into appropriate HTML string output that is sent to the
+    user.
 
-        results[page].append('<li><a href="%s">%s</a>' % (\
-                            django_reverse('ucomment-root') + page.link_name +\
-                            '/?highlight=' + ' '.join(search_words) + \
-                            '&with_case=' + str(with_case), page.html_title))
-        if page_counts[page] > 1:
-            results[page].append(('<span id="ucomment-search-count">'
-                                '[%d hits]</span>') % page_counts[page])
-        else:
-            results[page].append(('<span id="ucomment-search-count">'
-                                '[%d hit]</span>') % page_counts[page])
-        results[page].append('<div id="ucomment-search-result-context">')
-        results[page].append('%s</div></li>' % display)
-        n_pages += 1
+    Uses ``context`` number of characters around the search word to display
+    in the results.
+
+    The ``with_case`` input will either ``True`` (indicating case-sensitive
+    search was requested), or ``False``.
 
+    Only the results from ``offset`` onwards, and at most ``limit`` of them,
+    are formatted (all results if ``limit`` is None); the snippets are only
+    computed for these pages.  If ``base_url`` is given, then links to the
+    previous and next result pages are added, by appending
+    ``offset=.../limit=...`` to it.
+    """
+    n_pages, top, search_re = search_and_rank_pages(pages, with_case, offset,
+                                                    limit)
     resp = ['<div id=ucomment-search-results>\n<h2>Search results</h2>']
     if n_pages == 0:
         resp.append('<p>There were no pages matching your query.</p></div>')
@@ -2523,21 +3404,124 @@ def format_search_pages_for_web(pages, context, with_case):
     elif n_pages == 1:
         resp.append(('Found 1 page matching your search query.'))
     else:
-        resp.append(('Found %d pages matching your search query.')%len(pages))
+        resp.append(('Found %d pages matching your search query.') % n_pages)
+    if top and (offset > 0 or len(top) < n_pages):
+        resp.append(' Showing results %d to %d.' % (offset+1,
+                                                     offset+len(top)))
 
-    # How to sort by relevance: crude metric is to sort the pages in order
-    # of number of counts from high to low.
-    out = sorted(zip(page_counts.values(), page_counts.keys()), reverse=True)
     entries = []
-    for item in out:
-        # access the dictionary by ``page`` and get the contextual output string
-        entries.append('\n'.join(results[item[1]]))
-
-    resp.append('\n\t<ul>\n' + '\t\t\n'.join(entries) + '\t</ul>\n</div>')
+    for n_hits, page in top:
+        _, display = search_snippet(page.search_text, search_re, context,
+                                    with_case)
+        entry = ['<li><a href="%s">%s</a>' % (\
+                            django_reverse('ucomment-root') + page.link_name +\
+                            '/?highlight=' + ' '.join(pages[page]) + \
+                            '&with_case=' + str(with_case), page.html_title)]
+        if n_hits > 1:
+            entry.append(('<span id="ucomment-search-count">'
+                          '[%d hits]</span>') % n_hits)
+        else:
+            entry.append(('<span id="ucomment-search-count">'
+                          '[%d hit]</span>') % n_hits)
+        entry.append('<div id="ucomment-search-result-context">')
+        entry.append('%s</div></li>' % display)
+        entries.append('\n'.join(entry))
+
+    resp.append('\n\t<ul>\n' + '\t\t\n'.join(entries) + '\t</ul>\n')
+
+    # Links to the previous and next page of results
+    if base_url and limit:
+        nav = []
+        if offset > 0:
+            href = '%soffset=%d/limit=%d' % (base_url, max(0, offset-limit),
+                                             limit)
+            nav.append('<a href="%s">Previous %d results</a>' % \
+                                            (django_html.escape(href), limit))
+        if offset + limit < n_pages:
+            href = '%soffset=%d/limit=%d' % (base_url, offset+limit, limit)
+            nav.append('<a href="%s">Next %d results</a>' % \
+                                    (django_html.escape(href),
+                                     min(limit, n_pages-offset-limit)))
+        if nav:
+            resp.append('<p id="ucomment-search-navigation">%s</p>\n' % \
+                                                            ' | '.join(nav))
+
+    resp.append('</div>')
     return ''.join(resp)
 
+def get_search_option(value, default):
+    """
+    Extracts the (non-negative) integer from URL options such as
+    ``/offset=20``, returning the ``default`` if it cannot be found.
+    """
+    try:
+        return max(0, int(str(value).strip('/').partition('=')[2]))
+    except ValueError:
+        return default
+
+# A page found by ``find_search_pages``: only the fields required to show the
+# search results, rather than the full ``Page`` object.
+SearchPage = namedtuple('SearchPage', 'pk link_name html_title search_text')
+
+def find_search_pages(search, search_type='AND', with_case=False):
+    """
+    Finds the pages that contain the words in the ``search`` string.  Stop
+    words are ignored.
+
+    Returns a dictionary.  The keys are ``SearchPage`` tuples, and the
+    corresponding values are the list of words that appear on that page.
+
+    For an "AND" ``search_type``, only pages containing all the words are
+    returned; any other type will return pages containing one or more words.
+    The words must match in case if ``with_case`` is True.
+
+    The database narrows down the pages, but the compressed search text (see
+    ``conf.compress_search_text``) of every page has to be checked here.
+    """
+    words = [word for word in search.split() if word not in STOP_WORDS]
+    results = {}
+    if not words:
+        return results
+
+    # The database's matching is only a first filter: it may ignore case
+    # even for ``text__contains``.  The words are checked again below.
+    if search_type == 'AND':
+        query = Q(text__icontains=words[0])
+        for word in words[1:]:
+            query = query & Q(text__icontains=word)
+    else:
+        query = Q(text__icontains=words[0])
+        for word in words[1:]:
+            query = query | Q(text__icontains=word)
+    candidates = models.PageSearchText.objects.exclude(text='').filter(
+                                            Q(is_compressed=True) | query)
+
+    candidates = candidates.values_list('page__pk', 'page__link_name',
+                                        'page__html_title', 'text',
+                                        'is_compressed')
+    if not with_case:
+        words_to_match = [word.lower() for word in words]
+    else:
+        words_to_match = words
+    for pk, link_name, html_title, text, is_compressed in candidates:
+        text = models.PageSearchText(text=text,
+                                     is_compressed=is_compressed).get_text()
+        if with_case:
+            match_text = text
+        else:
+            match_text = text.lower()
+        found_words = [word for word, match in zip(words, words_to_match) \
+                                                        if match in match_text]
+        if not found_words:
+            continue
+        # For an "AND" search, we only display pages that have all the words.
+        if search_type == 'AND' and len(found_words) != len(words):
+            continue
+        results[SearchPage(pk, link_name, html_title, text)] = found_words
+    return results
+
 def search_document(request, search_terms='', search_type='AND',
-                       with_case=False):
+                       with_case=False, offset=0, limit=None):
     """ Will search the document for words within the string ``search_terms``.
 
     The results will be returned as hyperlinks containing ``CONTEXT`` number of
@@ -2549,16 +3533,23 @@ def search_document(request, search_terms='', search_type='AND',
     appear on the page.
 
     By default the search is case-insensitive (``with_case`` is False).
+
+    Results are paginated: only ``limit`` results, starting from ``offset``,
+    are returned (see ``search_results_per_page`` in the settings file).
     """
     CONTEXT = 90   # characters around the search term
     if request.method == 'GET':
         search = str(search_terms)
-        search_type = str(search_type).strip('/').upper()
+        search_type = str(search_type or '').strip('/').upper()
         if search_type == '':
             search_type = 'AND'
         with_case = str(with_case).strip('/').lower()=='true'
         if with_case == '':
             with_case = False
+        offset = get_search_option(offset, 0)
+        limit = get_search_option(limit, conf.search_results_per_page)
+        limit = min(limit or conf.search_results_per_page,
+                    conf.search_results_max_per_page)
 
     elif request.method == 'POST':
         # This seemingly messy code redirects back to a GET request so that
@@ -2574,33 +3565,15 @@ def search_document(request, search_terms='', search_type='AND',
                     search +'/'+ search_type +'/'+ 'case=' + str(with_case))
 
     start_time = time.time()
-    search_for = search.split()
-
-    results = defaultdict(list)
-    n_search_words = 0
-    for word in search_for:
-        # Filter out certain stop words
-        if word not in STOP_WORDS:
-            if with_case:
-                pages = models.Page.objects.filter(search_text__icontains=word)
-            else:
-                pages = models.Page.objects.filter(
-                                           search_text__icontains=word.lower())
-            n_search_words += 1
-            for page in pages:
-                results[page].append(word)
-
-    # If it's an "or" search then we simply display all pages that appear as
-    # keys in ``results``.  For an "AND" search, we only display pages that
-    # have ``n_search_words`` entries in the corresponding dictionary value.
-    if search_type == 'AND':
-        out = {}
-        for page, found_words in results.iteritems():
-            if len(found_words) == n_search_words:
-                out[page] = found_words
-        results = out
+    results = find_search_pages(search, search_type, with_case)
 
-    web_output = format_search_pages_for_web(results, CONTEXT, with_case)
+    # The search terms come from the user: quote them for use in the links
+    base_url = ''.join([django_reverse('ucomment-search-document'),
+                        urllib.quote(search.encode('utf-8')), '/',
+                        urllib.quote(search_type.encode('utf-8')),
+                        '/case=', str(with_case), '/'])
+    web_output = format_search_pages_for_web(results, CONTEXT, with_case,
+                                             offset, limit, base_url)
 
     # Create a psuedo-"Page" object containing the search results and return
     # that to the user.  It is infact a named tuple, which has the same
@@ -2626,6 +3599,74 @@ def search_document(request, search_terms='', search_type='AND',
                                                      time.time() - start_time))
     return render_page_for_web(search_output, request, search)
 
+def search_api(request):
+    """
+    A lightweight search, used by the Javascript to show results as the user
+    types in the search box, without a full page reload.  Uses the same pages
+    and ranking as ``search_document``, but returns the results as JSON.
+
+    GET parameters: ``q`` (the search terms), and the optional ``type``
+    ("AND" or "OR"), ``case`` ("true" or "false"), ``offset`` and ``limit``.
+
+    The JSON response contains the ``total`` number of matching pages and a
+    list of ``results``, each with the page ``id``, ``title``, ``link``,
+    number of ``hits`` and an HTML ``snippet``.  Responses are cached for
+    ``search_api_cache_timeout`` seconds.
+    """
+    if request.method != 'GET':
+        log_file.info((request.method + ' method for search API received; '
+                       'not handled; return 400.'))
+        return HttpResponse(status=400)
+
+    start_time = time.time()
+    search = request.GET.get('q', '').strip()
+    search_type = request.GET.get('type', 'AND').upper()
+    with_case = request.GET.get('case', 'false').lower() == 'true'
+    try:
+        offset = max(0, int(request.GET.get('offset', 0)))
+    except ValueError:
+        offset = 0
+    try:
+        limit = int(request.GET.get('limit', conf.search_api_results))
+    except ValueError:
+        limit = conf.search_api_results
+    if limit <= 0:
+        limit = conf.search_api_results
+    limit = min(limit, conf.search_api_max_results)
+
+    key = '\n'.join([search, search_type, str(with_case), str(offset),
+                     str(limit)])
+    cache_key = 'search_api__' + md5(key.encode('utf-8')).hexdigest()
+    response = django_cache.cache.get(cache_key)
+    if response is None:
+        pages = find_search_pages(search, search_type, with_case)
+        n_pages, top, search_re = search_and_rank_pages(pages, with_case,
+                                                        offset, limit)
+        results = []
+        for n_hits, page in top:
+            _, snippet = search_snippet(page.search_text, search_re,
+                                        conf.search_api_context, with_case,
+                                        n_instances=1)
+            results.append({'id': page.pk,
+                            'title': page.html_title,
+                            'link': django_reverse('ucomment-root') + \
+                                                        page.link_name + '/',
+                            'hits': n_hits,
+                            'snippet': snippet})
+
+        response = simplejson.dumps({'query': search,
+                                     'total': n_pages,
+                                     'offset': offset,
+                                     'limit': limit,
+                                     'results': results})
+        if conf.search_api_cache_timeout:
+            django_cache.cache.set(cache_key, response,
+                                   timeout=conf.search_api_cache_timeout)
+
+    log_file.debug('SEARCH API: "%s" :: took %f secs' % (search,
+                                                    time.time() - start_time))
+    return HttpResponse(response, mimetype='application/javascript')
+
 def admin_signin(request):
     """
     Perform administrator/author features for the application.
@@ -2637,12 +3678,19 @@ def admin_signin(request):
         msg = ('<ul>'
                '<li><a href="%s">Table of Contents for your document</a>'
                '<li><a href="%s">The Django admin page for your site</a>'
-               '<li><a href="%s">Publish or update the document</a>'
+               '<li><a href="%s">Publish or update the document</a> '
+               '(or <a href="%s?force=1">republish every page</a>; '
+               '<a href="%s">preview the changes</a> first)'
+               '<li>Timings of <a href="%s">recent publishes</a>'
                '<li>Backup your application by <a href="%s">dumping objects '
                'to fixtures</a>') % \
                (django_reverse('ucomment-root'),
                 django_reverse('admin:index'),
                 django_reverse('ucomment-publish-update-document'),
+                django_reverse('ucomment-publish-update-document'),
+                django_reverse('ucomment-publish-plan'),
+                django_reverse('admin:%s_publishjob_changelist' % \
+                               models.PublishJob._meta.app_label),
                 django_reverse('ucomment-dump-fixtures'))
         return HttpResponse(msg, status=200)
     elif request.method == 'GET':